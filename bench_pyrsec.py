@@ -0,0 +1,65 @@
+import sys
+import time
+
+from pyrsec import RegExp, String, parse_many_threaded
+from test_json import json
+
+
+def make_documents(n):
+    document = (
+        '{"id": %d, "name": "item %d", "tags": ["a", "b", "c"], '
+        '"price": %d.5, "stock": null, "active": true, '
+        '"dims": {"w": 1.0, "h": 2.0, "d": 3.0}}'
+    )
+    return ["[" + ", ".join(document % (i, i, i) for i in range(20)) + "]"] * n
+
+
+def bench_threads(documents, thread_counts=(1, 2, 4, 8)):
+    start = time.perf_counter()
+    expected = [json(document) for document in documents]
+    serial = time.perf_counter() - start
+    print(f"serial loop: {serial:.3f}s")
+    for threads in thread_counts:
+        start = time.perf_counter()
+        results = parse_many_threaded(json, documents, max_workers=threads)
+        elapsed = time.perf_counter() - start
+        assert [r for r, _ in results] == [r for r, _ in expected]
+        print(f"{threads} threads: {elapsed:.3f}s ({serial / elapsed:.2f}x)")
+
+
+def bench_batch(n):
+    parsers = {
+        "number": RegExp("-?[0-9]+(\\.[0-9]+)?").map(float),
+        "json": json,
+    }
+    sources = [str(i * 7 % 1000) + ".25" for i in range(n)]
+    for name, parser in parsers.items():
+        start = time.perf_counter()
+        expected = [parser(source)[0] for source in sources]
+        loop = time.perf_counter() - start
+        start = time.perf_counter()
+        batch = parser.parse_batch(sources)
+        elapsed = time.perf_counter() - start
+        assert batch.values == [r.value for r in expected]
+        print(f"{name}: loop {loop:.3f}s, batch {elapsed:.3f}s ({loop / elapsed:.2f}x)")
+
+
+def bench_partial(feed_counts=(10_000, 20_000, 40_000), fragment="abcdefghij"):
+    token = RegExp("[a-z]*").skip(String(";"))
+    for feeds in feed_counts:
+        start = time.perf_counter()
+        out = token.parse_partial("")
+        for _ in range(feeds):
+            out = out.feed(fragment)
+        result, _ = out.feed(";")
+        elapsed = time.perf_counter() - start
+        assert len(result.value) == feeds * len(fragment)
+        print(f"{feeds} feeds of one token: {elapsed:.3f}s")
+
+
+if __name__ == "__main__":
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(f"Python {sys.version.split()[0]}, GIL {'enabled' if gil else 'disabled'}")
+    bench_threads(make_documents(100))
+    bench_batch(100_000)
+    bench_partial()
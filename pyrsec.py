@@ -1,7 +1,26 @@
 from __future__ import annotations
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
 from typing import TypeVar, Generic, Tuple, Literal
+from array import array
+import contextvars
+import json
+import random
 import re
+import struct
+import time
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from functools import lru_cache
+import sys
+import threading
+import weakref
+
+try:
+    from re import _constants as _sre, _parser as _sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants as _sre, sre_parse as _sre_parse
 
 T = TypeVar("T")
 
@@ -26,194 +45,1191 @@ class CErr:
     pass
 
 
+_newline = re.compile("\n")
+_newline_bytes = re.compile(b"\n")
+
+
+class BudgetExceeded(Exception):
+    def __init__(self, message, offset, steps):
+        super().__init__(f"{message} at offset {offset} after {steps} steps")
+        self.offset = offset
+        self.steps = steps
+
+
+_DEADLINE_INTERVAL = 64
+
+
+@dataclass(eq=False)
+class Context:
+    recognize: bool = False
+    deferred: bool = False
+    limited: bool = False
+    steps: int = 0
+    furthest: int = 0
+    max_steps: int | None = None
+    deadline: float | None = None
+    memo: dict = field(default_factory=dict, repr=False)
+    growing: list = field(default_factory=list, repr=False)
+    tracer: Tracer | None = None
+    partial: _Feed | _Chunks | None = None
+    _line_source: str | memoryview | None = field(default=None, repr=False)
+    _line_starts: list[int] | None = field(default=None, repr=False)
+
+    def limit(self, max_steps=None, deadline=None):
+        self.max_steps = max_steps
+        self.deadline = deadline
+        self.limited = max_steps is not None or deadline is not None
+
+    # Budget errors report the furthest offset reached, which stays
+    # meaningful while a backtracking parse keeps returning to early offsets.
+    def tick(self, state):
+        self.steps += 1
+        if state.i > self.furthest:
+            self.furthest = state.i
+        if self.max_steps is not None and self.steps > self.max_steps:
+            raise BudgetExceeded("Step budget exhausted", self.furthest, self.steps)
+        if (
+            self.deadline is not None
+            and self.steps % _DEADLINE_INTERVAL == 0
+            and time.monotonic() > self.deadline
+        ):
+            raise BudgetExceeded("Deadline passed", self.furthest, self.steps)
+
+    def position(self, source, i):
+        if self._line_source is not source:
+            newline = _newline if isinstance(source, str) else _newline_bytes
+            starts = [0]
+            starts.extend(match.end() for match in newline.finditer(source))
+            self._line_source, self._line_starts = source, starts
+        line = bisect_right(self._line_starts, i)
+        return Position(i, line, i - self._line_starts[line - 1])
+
+
+@dataclass(frozen=True)
+class Position:
+    offset: int
+    line: int
+    col: int
+
+
+@dataclass
+class Located(Generic[T]):
+    value: T
+    start: Position
+    end: Position
+
+
+class Tracer:
+    def __init__(self, max_depth=None, sample=1, clock=time.perf_counter_ns):
+        self.max_depth = max_depth
+        self.sample = sample
+        self.clock = clock
+        self.events = []
+        self.depth = 0
+        self.calls = 0
+        self.recording = True
+
+    def trace(self, parser, state):
+        depth = self.depth
+        if depth == 0:
+            self.recording = self.calls % self.sample == 0
+            self.calls += 1
+        record = self.recording and (self.max_depth is None or depth < self.max_depth)
+        if not record:
+            self.depth += 1
+            try:
+                return parser.parse(state)
+            finally:
+                self.depth -= 1
+        name = str(parser.desc)
+        self.events.append(("B", name, state.i, self.clock(), None))
+        self.depth += 1
+        try:
+            result, new_state = parser.parse(state)
+        except BaseException as e:
+            self.events.append(("E", name, state.i, self.clock(), type(e).__name__))
+            raise
+        finally:
+            self.depth -= 1
+        outcome = type(result).__name__
+        self.events.append(("E", name, new_state.i, self.clock(), outcome))
+        return result, new_state
+
+    def to_chrome_trace(self):
+        start = self.events[0][3] if self.events else 0
+        events = []
+        for phase, name, offset, ts, outcome in self.events:
+            args = {"offset": offset}
+            if outcome is not None:
+                args["result"] = outcome
+            events.append(
+                {
+                    "name": name,
+                    "ph": phase,
+                    "ts": (ts - start) / 1000,
+                    "pid": 0,
+                    "tid": 0,
+                    "args": args,
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ns"}
+
+    def write_chrome_trace(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+
+    def to_collapsed(self):
+        totals = {}
+        stack = []
+        for phase, name, _, ts, _ in self.events:
+            if phase == "B":
+                name = name.replace(";", ",").replace("\n", "\\n")
+                stack.append([name, ts, 0])
+            else:
+                name, start, children = stack.pop()
+                elapsed = ts - start
+                key = ";".join([frame[0] for frame in stack] + [name])
+                totals[key] = totals.get(key, 0) + elapsed - children
+                if stack:
+                    stack[-1][2] += elapsed
+        return "".join(f"{key} {ns}\n" for key, ns in totals.items())
+
+
+class _Action:
+    __slots__ = ("f", "args", "value", "done")
+
+    def __init__(self, f, args):
+        self.f = f
+        self.args = args
+        self.done = False
+
+    # Left-associative chains build deep trees, so actions are forced
+    # post-order from an explicit stack rather than by recursion.
+    def force(self):
+        stack = [self]
+        while stack:
+            action = stack[-1]
+            if action.done:
+                stack.pop()
+                continue
+            pending = [
+                arg for arg in action.args if type(arg) is _Action and not arg.done
+            ]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            action.value = action.f(
+                *[arg.value if type(arg) is _Action else arg for arg in action.args]
+            )
+            action.done = True
+            action.args = None
+        return self.value
+
+
+def _force(value):
+    return value.force() if type(value) is _Action else value
+
+
+def _collect(*values):
+    return list(values)
+
+
+# Many's `collect` accepts an array or bytearray to copy the type of, or a
+# zero-argument factory for an object with `append` and an optional `finish`.
+def _collector(collect):
+    if isinstance(collect, array):
+        typecode = collect.typecode
+        return lambda: array(typecode)
+    if isinstance(collect, bytearray):
+        return bytearray
+    if collect is None or callable(collect):
+        return collect
+    raise TypeError(f"Cannot collect into {collect!r}.")
+
+
+def _finish(values):
+    finish = getattr(values, "finish", None)
+    return values if finish is None else finish()
+
+
+def _first(x, _y):
+    return x
+
+
+def _second(_x, y):
+    return y
+
+
+def _tuple(x, y):
+    return (x, y)
+
+
 @dataclass
 class State:
-    source: str
+    source: str | memoryview
     i: int = 0
     expected: Tuple[str] = tuple()
+    ctx: Context | None = field(default=None, compare=False, repr=False)
 
     def advance(self, j):
-        return State(self.source, i=self.i + j)
+        return State(self.source, self.i + j, ctx=self.ctx)
 
     def append_expected(self, s):
-        return State(self.source, self.i, (*self.expected, s))
+        return State(self.source, self.i, (*self.expected, s), self.ctx)
 
     def reset_expected(self):
-        return State(self.source, self.i)
+        return State(self.source, self.i, ctx=self.ctx)
+
+    def position(self):
+        return (self.ctx or Context()).position(self.source, self.i)
+
+
+def to_state(state, max_steps=None, deadline=None, tracer=None):
+    match state:
+        case State(_):
+            if state.ctx is None:
+                state = State(state.source, state.i, state.expected, Context())
+        case str(source):
+            state = State(source, ctx=Context())
+        case bytes() | bytearray() | memoryview():
+            state = State(memoryview(state).cast("B"), ctx=Context())
+        case _:
+            raise TypeError(
+                "Argument must be a string, a bytes-like object or a State instance."
+            )
+    if max_steps is not None or deadline is not None or tracer is not None:
+        # Limits and tracers apply to this call only, not to later parses of
+        # a State passed in.
+        ctx = replace(state.ctx, steps=0, furthest=state.i)
+        state = State(state.source, state.i, state.expected, ctx)
+        if max_steps is not None or deadline is not None:
+            ctx.limit(max_steps, deadline)
+        if tracer is not None:
+            ctx.tracer = tracer
+    return state
 
 
 class Parser:
     def __init__(self, p):
         self.p = p
 
-    def __call__(self, state):
-        match state:
-            case str(source):
-                state = State(source)
-            case State(_):
-                pass
-            case _:
-                raise TypeError("Argument must be a string or a State instance.")
+    def __call__(self, state, max_steps=None, deadline=None, tracer=None):
+        state = to_state(state, max_steps, deadline, tracer)
+        ctx = state.ctx
+        if ctx.limited:
+            ctx.tick(state)
+        if ctx.tracer is not None and self.desc is not None:
+            return ctx.tracer.trace(self, state)
+        return self.parse(state)
+
+    def parse(self, state):
         return self.p(state)
 
     @property
     def desc(self):
         return getattr(self, "_desc", None)
 
+    @property
+    def children(self):
+        return ()
+
     @staticmethod
     def alt(*args):
-        def q(state):
-            for p in args:
-                result, state = p(state)
-                match result:
-                    case COk(_) | EOk(_):
-                        return result, state
-                    case CErr():
-                        return CErr(), state
-                    case _:
-                        continue
-            return EErr(), state
-
-        return Parser(q)
+        return Alt(*args)
 
     @staticmethod
     def seq(*args):
-        def q(state):
-            consumed = False
-            values = []
-            for p in args:
-                result, state = p(state)
-                match result:
-                    case COk(value):
-                        consumed = True
-                        values.append(value)
-                    case EOk(value):
-                        values.append(value)
-                    case CErr():
-                        return CErr(), state
-                    case EErr():
-                        if consumed:
-                            return CErr(), state
-                        else:
-                            return EErr(), state
-            if consumed:
-                return COk(values), state
-            else:
-                return EOk(values), state
-
-        return Parser(q)
+        return Seq(*args)
 
     def set_desc(self, _desc):
         self._desc = _desc
         return self
 
     def chain(self, f):
-        def q(state):
-            result, state = self(state)
-            match result:
-                case COk(value):
-                    result, state = f(value)(state)
-                    match result:
-                        case COk(value) | EOk(value):
-                            return COk(value), state
-                        case EErr() | CErr():
-                            return CErr(), state
-                case EOk(value):
-                    result, state = f(value)(state)
-                    match result:
-                        case COk(value):
-                            return COk(value), state
-                        case EOk(value):
-                            return EOk(value), state
-                        case _:
-                            return result, state
-                case _:
-                    return result, state
-
-        return Parser(q)
+        return Chain(self, f)
 
     def map(self, f):
-        return self.chain(lambda x: Return(f(x)))
+        return Map(self, f)
 
     def then(self, q):
-        return self.chain(lambda _: q)
+        return Then(self, q)
 
     def skip(self, q):
-        return self.chain(lambda x: q.map(lambda _: x))
+        return Skip(self, q)
 
     def t(self):
         return self.skip(opt_whitespace)
 
     def lookahead(self):
-        def q(state):
-            result, _ = self(state)
+        return Lookahead(self)
+
+    def or_(self, q):
+        return Or(self, q)
+
+    def pair(self, q, f=None):
+        return Pair(self, q, f)
+
+    def many(self, collect=None):
+        return Many(self, collect)
+
+    def recognize(self):
+        return Recognize(self)
+
+    def parse_batch(self, sources):
+        values = []
+        failed = bytearray(len(sources))
+        fast = _regexp_batch(self)
+        if fast is not None:
+            match, fs = fast
+            for k, source in enumerate(sources):
+                m = match(source)
+                if m is None:
+                    values.append(None)
+                    failed[k] = 1
+                    continue
+                value = m.group(0)
+                for f in fs:
+                    value = f(value)
+                values.append(value)
+            return BatchResult(values, failed)
+        parse = self.parse
+        for k, source in enumerate(sources):
+            if isinstance(source, str):
+                state = State(source, ctx=Context())
+            else:
+                state = to_state(source)
+            result, _ = parse(state)
+            if type(result) is COk or type(result) is EOk:
+                values.append(_force(result.value))
+            else:
+                values.append(None)
+                failed[k] = 1
+        return BatchResult(values, failed)
+
+    def finditer(self, source):
+        state = to_state(source)
+        source, ctx = state.source, state.ctx
+        prefilter = _scan_prefilter(self, not isinstance(source, str))
+        i = 0
+        while i < len(source):
+            if prefilter is not None:
+                match = prefilter.search(source, i)
+                if match is None:
+                    return
+                i = match.start()
+            result, state = self(State(source, i, ctx=ctx))
+            if type(result) is COk:
+                yield (i, state.i), _force(result.value)
+                i = state.i
+            else:
+                i += 1
+
+    scan = finditer
+
+    def parse_partial(self, source):
+        if isinstance(source, (bytearray, memoryview)):
+            source = bytes(source)
+        feed = _Feed(source)
+        return feed.start(self, State(source, ctx=Context(partial=feed)))
+
+    def analyze(self):
+        return analyze(self)
+
+    def validate(self, source):
+        result, state = self._recognizing(to_state(source))
+        match result:
+            case COk(_) | EOk(_):
+                return state.i == len(state.source)
+            case _:
+                return False
+
+    def _recognizing(self, state):
+        ctx = state.ctx
+        recognize, ctx.recognize = ctx.recognize, True
+        try:
+            return self(state)
+        finally:
+            ctx.recognize = recognize
+
+    # Chain continuations and length prefixes need real values, even while
+    # the surrounding parse only recognizes.
+    def _evaluating(self, state):
+        ctx = state.ctx
+        if not ctx.recognize:
+            return self(state)
+        ctx.recognize = False
+        try:
+            return self(state)
+        finally:
+            ctx.recognize = True
+
+    def located(self):
+        return Locate(self)
+
+    def deferred(self):
+        return Deferred(self)
+
+    def cached(self, maxsize=128, key=hash, max_bytes=None, copy=False):
+        return Cached(self, ResultCache(maxsize, key, max_bytes, copy))
+
+    def iter_many(self, state, chunks=None):
+        state = _chunked(to_state(state), chunks)
+        consumed = False
+        while True:
+            result, new_state = _parse_chunked(self, state)
             match result:
-                case COk(value) | EOk(value):
-                    return EOk(value), state
-                case _:
-                    return EErr()
+                case COk(value):
+                    consumed = True
+                    state = new_state
+                    yield _force(value)
+                case EOk(value):
+                    raise Exception("Parser must consume.")
+                case EErr():
+                    result = COk(None) if consumed else EOk(None)
+                    return result, _unchunked(new_state)
+                case CErr():
+                    return CErr(), _unchunked(new_state)
+
+    def iter_sep_by(self, q, state, chunks=None):
+        state = _chunked(to_state(state), chunks)
+        result, new_state = _parse_chunked(self, state)
+        match result:
+            case COk(value) | EOk(value):
+                yield _force(value)
+            case EErr():
+                return EOk(None), _unchunked(new_state)
+            case CErr():
+                return CErr(), _unchunked(new_state)
+        rest, new_state = yield from q.then(self).iter_many(new_state)
+        match rest:
+            case CErr():
+                return rest, new_state
+            case COk(_):
+                return COk(None), new_state
+            case _:
+                return (COk(None) if type(result) is COk else EOk(None)), new_state
 
-        return Parser(q)
+    def many1(self, collect=None):
+        return Many(self, collect, min=1)
 
-    def or_(self, q):
-        def r(state):
-            result, state = self(state)
+    def sep_by(self, q, collect=None):
+        return Many(q.then(self), collect, head=self)
+
+
+class Alt(Parser):
+    def __init__(self, *parsers):
+        self.parsers = parsers
+
+    @property
+    def children(self):
+        return self.parsers
+
+    def parse(self, state):
+        for p in self.parsers:
+            result, state = p(state)
             match result:
-                case COk(_) | EOk(_) | CErr():
+                case COk(_) | EOk(_):
                     return result, state
+                case CErr():
+                    return CErr(), state
+                case _:
+                    continue
+        return EErr(), state
+
+
+class Seq(Parser):
+    def __init__(self, *parsers):
+        self.parsers = parsers
+
+    @property
+    def children(self):
+        return self.parsers
+
+    def parse(self, state):
+        consumed = False
+        values = None if state.ctx.recognize else []
+        for p in self.parsers:
+            result, state = p(state)
+            match result:
+                case COk(value):
+                    consumed = True
+                    if values is not None:
+                        values.append(value)
+                case EOk(value):
+                    if values is not None:
+                        values.append(value)
+                case CErr():
+                    return CErr(), state
                 case EErr():
-                    return q(state)
+                    if consumed:
+                        return CErr(), state
+                    else:
+                        return EErr(), state
+        if values is not None and state.ctx.deferred:
+            values = _Action(_collect, values)
+        if consumed:
+            return COk(values), state
+        else:
+            return EOk(values), state
 
-        return Parser(r)
 
-    def pair(self, q, f=None):
-        return self.chain(lambda x: q.map(lambda y: (x, y) if f is None else f(x, y)))
+class Chain(Parser):
+    def __init__(self, p, f):
+        self.p = p
+        self.f = f
+
+    @property
+    def children(self):
+        return (self.p,)
+
+    def parse(self, state):
+        result, state = self.p._evaluating(state)
+        match result:
+            case COk(value):
+                result, state = self.f(_force(value))(state)
+                match result:
+                    case COk(value) | EOk(value):
+                        return COk(value), state
+                    case EErr() | CErr():
+                        return CErr(), state
+            case EOk(value):
+                result, state = self.f(_force(value))(state)
+                match result:
+                    case COk(value):
+                        return COk(value), state
+                    case EOk(value):
+                        return EOk(value), state
+                    case _:
+                        return result, state
+            case _:
+                return result, state
+
+
+class Map(Parser):
+    def __init__(self, p, f):
+        self.p = p
+        self.f = f
+
+    @property
+    def children(self):
+        return (self.p,)
+
+    def parse(self, state):
+        ctx = state.ctx
+        result, state = self.p(state)
+        match result:
+            case COk(value) | EOk(value) if ctx.recognize:
+                return result, state
+            case COk(value):
+                value = _Action(self.f, (value,)) if ctx.deferred else self.f(value)
+                return COk(value), state
+            case EOk(value):
+                value = _Action(self.f, (value,)) if ctx.deferred else self.f(value)
+                return EOk(value), state
+            case _:
+                return result, state
+
+
+class Pair(Parser):
+    action = True
+
+    def __init__(self, p, q, f=None):
+        self.p = p
+        self.q = q
+        self.f = _tuple if f is None else f
+
+    @property
+    def children(self):
+        return (self.p, self.q)
+
+    def parse(self, state):
+        ctx = state.ctx
+        result, state = self.p(state)
+        match result:
+            case COk(x):
+                consumed = True
+            case EOk(x):
+                consumed = False
+            case _:
+                return result, state
+        result, state = self.q(state)
+        match result:
+            case COk(y) | EOk(y):
+                if not self.action:
+                    value = self.f(x, y)
+                elif ctx.recognize:
+                    value = None
+                elif ctx.deferred:
+                    value = _Action(self.f, (x, y))
+                else:
+                    value = self.f(x, y)
+                if consumed or type(result) is COk:
+                    return COk(value), state
+                return EOk(value), state
+            case _:
+                return (CErr() if consumed else result), state
+
+
+class Then(Pair):
+    action = False
+
+    def __init__(self, p, q):
+        super().__init__(p, q, _second)
+
+
+class Skip(Pair):
+    action = False
+
+    def __init__(self, p, q):
+        super().__init__(p, q, _first)
+
+
+class Lookahead(Parser):
+    def __init__(self, p):
+        self.p = p
+
+    @property
+    def children(self):
+        return (self.p,)
+
+    def parse(self, state):
+        result, _ = self.p(state)
+        match result:
+            case COk(value) | EOk(value):
+                return EOk(value), state
+            case _:
+                return EErr(), state
+
+
+class Or(Parser):
+    def __init__(self, p, q):
+        self.p = p
+        self.q = q
+
+    @property
+    def children(self):
+        return (self.p, self.q)
+
+    def parse(self, state):
+        result, state = self.p(state)
+        match result:
+            case COk(_) | EOk(_) | CErr():
+                return result, state
+            case EErr():
+                return self.q(state)
+
+
+class Many(Parser):
+    def __init__(self, p, collect=None, head=None, min=0):
+        self.p = p
+        self.collect = _collector(collect)
+        self.head = head
+        self.min = min
+        self.consumes = False
+        _check_many(self)
+
+    @property
+    def children(self):
+        return (self.p,) if self.head is None else (self.head, self.p)
 
-    def many(self):
-        def r(state):
-            consumed = False
+    def _build(self, *values):
+        collection = self.collect()
+        for value in values:
+            collection.append(value)
+        return _finish(collection)
+
+    def parse(self, state):
+        p = self.p
+        ctx = state.ctx
+        collect = self.collect
+        consumed = False
+        if ctx.recognize:
+            values = None
+        elif collect is None or ctx.deferred:
             values = []
+        else:
+            values = collect()
+        more = True
+        if self.head is not None or self.min:
+            # The first item comes from `head` if given, which may succeed
+            # without consuming. If it fails, Many succeeds empty unless `min`
+            # is set.
+            result, new_state = (p if self.head is None else self.head)(state)
+            match result:
+                case EOk(_) if self.head is None:
+                    raise Exception("Parser must consume.")
+                case COk(value) | EOk(value):
+                    consumed = type(result) is COk
+                    if values is not None:
+                        values.append(value)
+                    state = new_state
+                case EErr():
+                    if self.min:
+                        return EErr(), state
+                    more = False
+                case CErr():
+                    return CErr(), new_state
+        if more and self.consumes:
+            # The grammar analysis proved that p never succeeds without
+            # consuming, so EOk needs no check here.
+            while True:
+                result, state = p(state)
+                kind = type(result)
+                if kind is COk:
+                    consumed = True
+                    if values is not None:
+                        values.append(result.value)
+                elif kind is EErr:
+                    break
+                else:
+                    return CErr(), state
+        elif more:
             while True:
-                result, state = self(state)
+                result, state = p(state)
                 match result:
                     case COk(value):
                         consumed = True
-                        values.append(value)
+                        if values is not None:
+                            values.append(value)
                     case EOk(value):
                         raise Exception("Parser must consume.")
                     case EErr():
                         break
                     case CErr():
                         return CErr(), state
-            if consumed:
-                return COk(values), state
+        if values is not None:
+            if ctx.deferred:
+                values = _Action(_collect if collect is None else self._build, values)
+            elif collect is not None:
+                values = _finish(values)
+        if consumed:
+            return COk(values), state
+        else:
+            return EOk(values), state
+
+
+class Recognize(Parser):
+    def __init__(self, p):
+        self.p = p
+
+    @property
+    def children(self):
+        return (self.p,)
+
+    def parse(self, state):
+        result, new_state = self.p._recognizing(state)
+        match result:
+            case COk(_):
+                return COk(new_state.source[state.i : new_state.i]), new_state
+            case EOk(_):
+                return EOk(state.source[state.i : state.i]), new_state
+            case _:
+                return result, new_state
+
+
+class Locate(Parser):
+    def __init__(self, p):
+        self.p = p
+
+    @property
+    def children(self):
+        return (self.p,)
+
+    def parse(self, state):
+        result, new_state = self.p(state)
+        match result:
+            case COk(value) | EOk(value) if not state.ctx.recognize:
+                ctx = state.ctx
+                start = ctx.position(state.source, state.i)
+                end = ctx.position(new_state.source, new_state.i)
+                if ctx.deferred:
+                    value = _Action(Located, (value, start, end))
+                else:
+                    value = Located(value, start, end)
+                return (COk if type(result) is COk else EOk)(value), new_state
+            case _:
+                return result, new_state
+
+
+class Deferred(Parser):
+    def __init__(self, p):
+        self.p = p
+
+    @property
+    def children(self):
+        return (self.p,)
+
+    def parse(self, state):
+        ctx = state.ctx
+        deferred, ctx.deferred = ctx.deferred, True
+        try:
+            result, state = self.p(state)
+        finally:
+            ctx.deferred = deferred
+        match result:
+            case COk(value) if not deferred:
+                return COk(_force(value)), state
+            case EOk(value) if not deferred:
+                return EOk(_force(value)), state
+            case _:
+                return result, state
+
+
+@dataclass(frozen=True)
+class CacheInfo:
+    hits: int
+    misses: int
+    size: int
+    nbytes: int
+
+
+# Estimated memory held by a cached result: getsizeof summed over the objects
+# reachable through containers and instance attributes.
+def _deep_sizeof(value):
+    total = 0
+    seen = set()
+    stack = [value]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        match obj:
+            case str() | bytes() | bytearray() | memoryview() | int() | float():
+                pass
+            case dict():
+                stack.extend(obj.keys())
+                stack.extend(obj.values())
+            case list() | tuple() | set() | frozenset():
+                stack.extend(obj)
+            case _ if hasattr(obj, "__dict__"):
+                stack.append(vars(obj))
+    return total
+
+
+class ResultCache:
+    def __init__(self, maxsize=128, key=hash, max_bytes=None, copy=False):
+        self.maxsize = maxsize
+        self.key = key
+        self.max_bytes = max_bytes
+        self.copy = copy
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def parse(self, parser, state):
+        state = to_state(state)
+        ctx = state.ctx
+        if state.i != 0 or ctx.recognize or ctx.deferred or ctx.partial is not None:
+            return parser(state)
+        source = state.source
+        # Results for a mutable buffer could go stale.
+        if isinstance(source, memoryview) and not source.readonly:
+            return parser(state)
+        k = (parser, self.key(source))
+        with self._lock:
+            entry = self._entries.get(k)
+            if entry is not None and entry[0] == source:
+                self._entries.move_to_end(k)
+                self.hits += 1
             else:
-                values == []
-                return EOk(values), state
+                entry = None
+                self.misses += 1
+        if entry is None:
+            result, new_state = parser(state)
+            match result:
+                case COk(_) | EOk(_):
+                    self._store(k, source, result, new_state)
+            return result, new_state
+        _, result, i, expected, _ = entry
+        if self.copy:
+            result = type(result)(deepcopy(result.value))
+        return result, State(source, i, expected, ctx)
+
+    def _store(self, k, source, result, state):
+        if self.copy:
+            result = type(result)(deepcopy(result.value))
+        if isinstance(source, memoryview):
+            nbytes = source.nbytes
+        else:
+            nbytes = sys.getsizeof(source)
+        nbytes += _deep_sizeof(result)
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if k in self._entries:
+                self.nbytes -= self._entries.pop(k)[4]
+            self._entries[k] = (source, result, state.i, state.expected, nbytes)
+            self.nbytes += nbytes
+            while len(self._entries) > self.maxsize or (
+                self.max_bytes is not None and self.nbytes > self.max_bytes
+            ):
+                self.nbytes -= self._entries.popitem(last=False)[1][4]
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, len(self._entries), self.nbytes)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.nbytes = 0
+
+
+class Cached(Parser):
+    def __init__(self, p, cache):
+        self.p = p
+        self.cache = cache
+
+    @property
+    def children(self):
+        return (self.p,)
+
+    def parse(self, state):
+        return self.cache.parse(self.p, state)
+
+
+@dataclass
+class BatchResult:
+    values: list
+    failed: bytearray
+
+
+# RegExp parsers, possibly wrapped in maps, run as a single compiled match per
+# input in parse_batch.
+def _regexp_batch(parser):
+    fs = []
+    while type(parser) is Map:
+        fs.append(parser.f)
+        parser = parser.p
+    if type(parser) is not RegExp:
+        return None
+    return parser.pattern.match, fs[::-1]
+
 
-        return Parser(r)
+def _at_end(feed, i):
+    return i >= feed.length
 
-    def many1(self):
-        return self.chain(lambda x: self.many().map(lambda xs: [x, *xs]))
 
-    def sep_by(self, q):
-        return self.chain(lambda x: q.then(self).many().map(lambda xs: [x, *xs])).or_(
-            Return([])
+# A RegExp token longer than this is not re-checked against all of its text
+# on every feed. Until the text buffered since its start doubles, new text
+# made only of characters the pattern can continue with is assumed to extend
+# it. That keeps feeding long tokens linear, and only delays the answer.
+_RESCAN_LENGTH = 4096
+
+
+class _Abandoned(BaseException):
+    pass
+
+
+class _Feed:
+    def __init__(self, source):
+        self.buffer = source
+        self.fragments = []
+        self.starts = []
+        self.length = len(source)
+        self.final = False
+        self.offset = None
+        self.waiting = False
+        self.abandoned = False
+        self.generation = 0
+        self.done = False
+        self.outcome = None
+        self.error = None
+        self.cond = threading.Condition()
+
+    def start(self, parser, state):
+        run = contextvars.copy_context().run
+        thread = threading.Thread(
+            target=run, args=(self._run, parser, state), daemon=True
         )
+        thread.start()
+        return self._outcome()
+
+    def _run(self, parser, state):
+        try:
+            self.outcome = parser(state)
+        except BaseException as e:
+            self.error = e
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+    def _outcome(self):
+        with self.cond:
+            while not self.waiting and not self.done:
+                self.cond.wait()
+            if not self.done:
+                self.generation += 1
+                return NeedMore(self, self.offset)
+        if self.error is not None:
+            raise self.error
+        return self.outcome
+
+    def resume(self, text, final):
+        with self.cond:
+            if self.done:
+                raise RuntimeError("The parse has already finished.")
+            if text:
+                self.starts.append(self.length)
+                self.fragments.append(text)
+                self.length += len(text)
+            self.final = final
+            self.waiting = False
+            self.cond.notify_all()
+        return self._outcome()
+
+    # Called when the latest NeedMore is garbage collected without being
+    # finished. The parsing thread unwinds instead of waiting forever.
+    def abandon(self, generation):
+        with self.cond:
+            if self.done or generation != self.generation:
+                return
+            self.abandoned = True
+            self.waiting = False
+            self.cond.notify_all()
+
+    # The input from i onwards as text[pos:], joining only the fragments
+    # after i.
+    def window(self, i):
+        if not self.fragments:
+            return self.buffer, i
+        empty = self.buffer[:0]
+        if i < len(self.buffer):
+            return self.buffer[i:] + empty.join(self.fragments), 0
+        k = bisect_right(self.starts, i) - 1
+        return empty.join(self.fragments[k:]), i - self.starts[k]
+
+    # Called from the parsing thread by primitives that reached the end of
+    # the buffer. Blocks until more input arrives or the input is finished.
+    # needs_more(feed, i) can use feed.length and feed.window(i) rather than
+    # the whole buffer.
+    def wait(self, state, needs_more):
+        while not self.final and needs_more(self, state.i):
+            with self.cond:
+                self.offset = state.i
+                self.waiting = True
+                self.cond.notify_all()
+                while self.waiting:
+                    self.cond.wait()
+                if self.abandoned:
+                    raise _Abandoned()
+        if self.fragments:
+            self.buffer = self.buffer + self.buffer[:0].join(self.fragments)
+            self.fragments.clear()
+            self.starts.clear()
+        source = self.buffer
+        if source is state.source:
+            return state
+        return State(source, state.i, state.expected, state.ctx)
+
+
+class NeedMore:
+    def __init__(self, feed, offset):
+        self._feed = feed
+        self.offset = offset
+        weakref.finalize(self, feed.abandon, feed.generation)
+
+    def __repr__(self):
+        return f"NeedMore(offset={self.offset})"
+
+    def feed(self, text):
+        return self._feed.resume(text, False)
+
+    def finish(self, text=None):
+        if text is None:
+            text = self._feed.buffer[:0]
+        return self._feed.resume(text, True)
+
+
+class _Suspended(BaseException):
+    pass
+
+
+# Input for iter_many and iter_sep_by read from an iterable of chunks. An
+# element that runs past the buffer is parsed again once more chunks are read,
+# and the input before it is dropped, so memory stays bounded by the chunk and
+# element sizes rather than the whole input.
+class _Chunks:
+    def __init__(self, source, chunks):
+        self.buffer = source
+        self.length = len(source)
+        self.chunks = iter(chunks)
+        self.final = False
+
+    def window(self, i):
+        return self.buffer, i
+
+    def wait(self, state, needs_more):
+        if not self.final and needs_more(self, state.i):
+            raise _Suspended()
+        return state
+
+    # Keeps the input from i onwards and reads chunks until it has at least
+    # doubled, so an element spanning many chunks is parsed a logarithmic
+    # number of times.
+    def pull(self, state):
+        parts = [self.buffer[state.i :]]
+        need = len(parts[0])
+        got = 0
+        while got <= need:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.final = True
+                break
+            parts.append(chunk)
+            got += len(chunk)
+        self.buffer = self.buffer[:0].join(parts)
+        self.length = len(self.buffer)
+        # Memo entries hold offsets into the old buffer.
+        state.ctx.memo, state.ctx.growing = {}, []
+        return State(self.buffer, 0, state.expected, state.ctx)
+
+
+def _chunked(state, chunks):
+    if chunks is None:
+        return state
+    source = state.source[state.i :]
+    if isinstance(source, memoryview):
+        source = bytes(source)
+    ctx = replace(state.ctx, partial=_Chunks(source, chunks), memo={}, growing=[])
+    return State(source, 0, state.expected, ctx)
+
+
+def _parse_chunked(parser, state):
+    feed = state.ctx.partial
+    if not isinstance(feed, _Chunks):
+        return parser(state)
+    while True:
+        try:
+            return parser(state)
+        except _Suspended:
+            state = feed.pull(state)
+
+
+# The state returned at the end of the iteration holds the rest of the input,
+# unread chunks included, and no longer reads from them.
+def _unchunked(state):
+    feed = state.ctx.partial
+    if not isinstance(feed, _Chunks):
+        return state
+    source = feed.buffer[:0].join([feed.buffer, *feed.chunks])
+    ctx = replace(state.ctx, partial=None)
+    return State(source, state.i, state.expected, ctx)
 
 
 class Return(Parser):
     def __init__(self, value):
         self.value = value
 
-    def __call__(self, state):
-        match state:
-            case str(source):
-                state = State(source)
-            case State(_):
-                pass
-            case _:
-                raise TypeError("Argument must be a string or a State instance.")
+    def __repr__(self):
+        return f"Return({self.value!r})"
+
+    def parse(self, state):
         return EOk(self.value), state
 
 
@@ -221,14 +1237,10 @@ class Error(Parser):
     def __init__(self, desc=None):
         self._desc = desc
 
-    def __call__(self, state):
-        match state:
-            case str(source):
-                state = State(source)
-            case State(_):
-                pass
-            case _:
-                raise TypeError("Argument must be a string or a State instance.")
+    def __repr__(self):
+        return f"Error({self._desc!r})"
+
+    def parse(self, state):
         return EErr(), state
 
 
@@ -236,14 +1248,12 @@ class EOF(Parser):
     def __init__(self, desc="EOF"):
         self._desc = desc
 
-    def __call__(self, state):
-        match state:
-            case str(source):
-                state = State(source)
-            case State(_):
-                pass
-            case _:
-                raise TypeError("Argument must be a string or a State instance.")
+    def __repr__(self):
+        return "EOF()"
+
+    def parse(self, state):
+        if state.ctx.partial is not None:
+            state = state.ctx.partial.wait(state, _at_end)
         if state.i == len(state.source):
             return EOk(None), state
         else:
@@ -251,11 +1261,53 @@ class EOF(Parser):
 
 
 class Lazy(Parser):
-    def __init__(self, thunk):
+    def __init__(self, thunk, left_recursive=False):
         self.thunk = thunk
+        self.left_recursive = left_recursive
 
-    def __call__(self, state):
-        return self.thunk()(state)
+    @property
+    def children(self):
+        return (self.thunk(),)
+
+    def parse(self, state):
+        if not self.left_recursive:
+            return self.thunk()(state)
+        ctx = state.ctx
+        key = (self, state.i, ctx.recognize, ctx.deferred)
+        memo = ctx.memo
+        growing = ctx.growing
+        if key in memo:
+            if (self, state.i) in growing:
+                # Another left-recursive rule started at this offset inside
+                # this one would keep its result from before this rule grew.
+                k = growing.index((self, state.i))
+                others = [lazy for lazy, i in growing[k + 1 :] if i == state.i]
+                if others:
+                    raise GrammarError(
+                        "Indirect left recursion: mark only one rule of the cycle "
+                        f"through {self!r} and {others[0]!r} as left_recursive."
+                    )
+            return memo[key]
+        # Seed the memo with a failure so the left-recursive reference falls
+        # through to the base case, then re-parse while the match keeps growing.
+        memo[key] = seed = (EErr(), state)
+        p = self.thunk()
+        growing.append((self, state.i))
+        try:
+            while True:
+                result, new_state = p(state)
+                ok = type(result) in (COk, EOk)
+                if memo[key] is seed:
+                    memo[key] = result, new_state
+                    if not ok:
+                        break
+                elif ok and new_state.i > memo[key][1].i:
+                    memo[key] = result, new_state
+                else:
+                    break
+        finally:
+            growing.pop()
+        return memo[key]
 
 
 class String(Parser):
@@ -264,15 +1316,19 @@ class String(Parser):
             raise ValueError("Argument cannot be the empty string.")
         self.s = s
 
-    def __call__(self, state):
-        match state:
-            case str(source):
-                state = State(source)
-            case State(_):
-                pass
-            case _:
-                raise TypeError("Argument must be a string or a State instance.")
+    def __repr__(self):
+        return f"String({self.s!r})"
+
+    def _needs_more(self, feed, i):
+        if feed.length - i >= len(self.s):
+            return False
+        text, pos = feed.window(i)
+        return self.s.startswith(text[pos:])
+
+    def parse(self, state):
         j = len(self.s)
+        if state.ctx.partial is not None:
+            state = state.ctx.partial.wait(state, self._needs_more)
         if state.source[state.i : state.i + j] == self.s:
             return COk(self.s), state.advance(j)
         else:
@@ -284,14 +1340,50 @@ class RegExp(Parser):
         self.pattern = re.compile(pattern)
         self._desc = pattern
 
-    def __call__(self, state):
-        match state:
-            case str(source):
-                state = State(source)
-            case State(_):
-                pass
-            case _:
-                raise TypeError("Argument must be a string or a State instance.")
+    def __repr__(self):
+        return f"RegExp({self.pattern.pattern!r})"
+
+    # The re module has no partial matching. More input can only change the
+    # outcome if the rest of the buffer is a prefix of something the pattern
+    # matches, which a derived prefix pattern decides. Patterns it can't
+    # handle wait whenever the match fails or reaches the end of the buffer.
+    def _needs_more(self):
+        prefix = _regexp_prefix(self.pattern.pattern, self.pattern.flags)
+        stream = _regexp_stream(self.pattern.pattern, self.pattern.flags)
+        checked = 0
+        seen = 0
+        closed = False
+
+        def needs_more(feed, i):
+            nonlocal checked, seen, closed
+            rest = feed.length - i
+            if stream is not None and checked:
+                alphabet, closers = stream
+                text, pos = feed.window(seen)
+                seen = feed.length
+                # Text after a closer is checked too, in case the token ended.
+                was_closed = closed
+                closed = closers is not None and closers.search(text, pos) is not None
+                if (
+                    _RESCAN_LENGTH < rest < 2 * checked
+                    and alphabet.fullmatch(text, pos)
+                    and not closed
+                    and not was_closed
+                ):
+                    return True
+            checked = rest
+            seen = feed.length
+            text, pos = feed.window(i)
+            if prefix is None:
+                match = self.pattern.match(text, pos)
+                return match is None or match.end() == len(text)
+            return prefix.fullmatch(text, pos) is not None
+
+        return needs_more
+
+    def parse(self, state):
+        if state.ctx.partial is not None:
+            state = state.ctx.partial.wait(state, self._needs_more())
         match = self.pattern.match(state.source, state.i)
         if match:
             value = match.group(0)
@@ -303,4 +1395,1096 @@ class RegExp(Parser):
             return EErr(), state
 
 
+class Satisfy(Parser):
+    def __init__(self, pred, desc=None):
+        self.pred = pred
+        self._desc = desc
+
+    def __repr__(self):
+        return f"Satisfy({getattr(self.pred, '__qualname__', self.pred)})"
+
+    def parse(self, state):
+        if state.ctx.partial is not None:
+            state = state.ctx.partial.wait(state, _at_end)
+        i = state.i
+        if i < len(state.source):
+            c = state.source[i]
+            if self.pred(c):
+                return COk(c), state.advance(1)
+        return EErr(), state
+
+
+class OneOf(Parser):
+    def __init__(self, chars, invert=False):
+        if not chars:
+            raise ValueError("Argument cannot be empty.")
+        self.chars = frozenset(chars)
+        self.binary = isinstance(chars, (bytes, bytearray))
+        self.invert = invert
+        self._desc = _char_class(self.chars, invert)
+
+    def __repr__(self):
+        return f"OneOf({_chars_repr(self)}, invert={self.invert})"
+
+    def parse(self, state):
+        if state.ctx.partial is not None:
+            state = state.ctx.partial.wait(state, _at_end)
+        i = state.i
+        if i < len(state.source):
+            c = state.source[i]
+            if (c in self.chars) != self.invert:
+                return COk(c), state.advance(1)
+        return EErr(), state
+
+
+class TakeWhile(Parser):
+    def __init__(self, chars, min=0):
+        if not chars:
+            raise ValueError("Argument cannot be empty.")
+        self.chars = frozenset(chars)
+        self.binary = isinstance(chars, (bytes, bytearray))
+        self.min = min
+        self._desc = _char_class(self.chars) + ("+" if min else "*")
+        pattern, run = self._desc, _char_class(self.chars) + "*"
+        if self.binary:
+            pattern, run = pattern.encode("latin-1"), run.encode("latin-1")
+        self.pattern = re.compile(pattern)
+        self._run = re.compile(run)
+
+    def __repr__(self):
+        return f"TakeWhile({_chars_repr(self)}, min={self.min})"
+
+    # Each check resumes the run where the previous one stopped.
+    def _needs_more(self):
+        end = None
+
+        def needs_more(feed, i):
+            nonlocal end
+            start = i if end is None else end
+            text, pos = feed.window(start)
+            end = start + self._run.match(text, pos).end() - pos
+            return end == feed.length
+
+        return needs_more
+
+    def parse(self, state):
+        if state.ctx.partial is not None:
+            state = state.ctx.partial.wait(state, self._needs_more())
+        match = self.pattern.match(state.source, state.i)
+        if match is None:
+            return EErr(), state
+        j = match.end() - state.i
+        if j == 0:
+            return EOk(state.source[state.i : state.i]), state
+        return COk(state.source[state.i : state.i + j]), state.advance(j)
+
+
+# Character sets hold characters, or byte values when built from bytes.
+def _char_class(chars, invert=False):
+    chars = sorted(chr(c) if isinstance(c, int) else c for c in chars)
+    return "[" + ("^" if invert else "") + "".join(map(re.escape, chars)) + "]"
+
+
+def _chars_repr(node):
+    if node.binary:
+        return repr(bytes(sorted(node.chars)))
+    return repr("".join(sorted(node.chars)))
+
+
+def satisfy(pred, desc=None):
+    return Satisfy(pred, desc)
+
+
+def one_of(chars):
+    return OneOf(chars)
+
+
+def none_of(chars):
+    return OneOf(chars, invert=True)
+
+
+def take_while(chars):
+    return TakeWhile(chars)
+
+
+def take_while1(chars):
+    return TakeWhile(chars, min=1)
+
+
+class Bytes(Parser):
+    def __init__(self, b):
+        if b == b"":
+            raise ValueError("Argument cannot be empty.")
+        self.b = bytes(b)
+        self._desc = repr(self.b)
+
+    def __repr__(self):
+        return f"Bytes({self.b!r})"
+
+    def _needs_more(self, feed, i):
+        if feed.length - i >= len(self.b):
+            return False
+        text, pos = feed.window(i)
+        return self.b.startswith(bytes(text[pos:]))
+
+    def parse(self, state):
+        j = len(self.b)
+        if state.ctx.partial is not None:
+            state = state.ctx.partial.wait(state, self._needs_more)
+        if state.source[state.i : state.i + j] == self.b:
+            return COk(self.b), state.advance(j)
+        else:
+            return EErr(), state
+
+
+class Take(Parser):
+    def __init__(self, n):
+        if n < 0:
+            raise ValueError("Argument must be non-negative.")
+        self.n = n
+        self._desc = f"{n} bytes"
+
+    def __repr__(self):
+        return f"Take({self.n})"
+
+    def parse(self, state):
+        j = self.n
+        if state.ctx.partial is not None:
+            state = state.ctx.partial.wait(state, lambda feed, i: i + j > feed.length)
+        if state.i + j > len(state.source):
+            return EErr(), state
+        value = state.source[state.i : state.i + j]
+        if j == 0:
+            return EOk(value), state
+        return COk(value), state.advance(j)
+
+
+class Struct(Parser):
+    def __init__(self, fmt):
+        self.struct = struct.Struct(fmt)
+        self._desc = fmt
+
+    def __repr__(self):
+        return f"Struct({self.struct.format!r})"
+
+    def parse(self, state):
+        size = self.struct.size
+        if state.ctx.partial is not None:
+            state = state.ctx.partial.wait(
+                state, lambda feed, i: i + size > feed.length
+            )
+        if state.i + size > len(state.source):
+            return EErr(), state
+        values = self.struct.unpack_from(state.source, state.i)
+        value = values[0] if len(values) == 1 else values
+        if size == 0:
+            return EOk(value), state
+        return COk(value), state.advance(size)
+
+
+class LengthPrefixed(Parser):
+    def __init__(self, p, length):
+        self.p = p
+        self.length = length
+
+    @property
+    def children(self):
+        return (self.length, self.p)
+
+    def parse(self, state):
+        result, after = self.length._evaluating(state)
+        match result:
+            case COk(n) | EOk(n):
+                n = _force(n)
+            case _:
+                return result, after
+        consumed = isinstance(result, COk)
+        end = after.i + n
+        partial = after.ctx.partial
+        if partial is not None:
+            after = partial.wait(after, lambda feed, i: end > feed.length)
+        if end > len(after.source):
+            return (CErr() if consumed else EErr()), state
+        ctx = after.ctx
+        window = State(after.source[:end], after.i, ctx=ctx)
+        # The window is complete, so the inner parser must not wait for input.
+        # Left-recursion memo entries made on the full source don't hold in
+        # the window, nor the other way round.
+        memo, growing = ctx.memo, ctx.growing
+        ctx.partial, ctx.memo, ctx.growing = None, {}, []
+        try:
+            result, inner = self.p(window)
+        finally:
+            ctx.partial, ctx.memo, ctx.growing = partial, memo, growing
+        match result:
+            case COk(value) | EOk(value) if inner.i == end:
+                pass
+            case _:
+                return (CErr() if consumed or n > 0 else EErr()), state
+        if consumed or n > 0:
+            return COk(value), after.advance(n)
+        return EOk(value), after
+
+
+class Visitor:
+    def __init__(self):
+        self.seen = set()
+
+    def visit(self, node):
+        return getattr(self, "visit_" + type(node).__name__, self.generic_visit)(node)
+
+    def generic_visit(self, node):
+        if isinstance(node, Lazy):
+            if node in self.seen:
+                return
+            self.seen.add(node)
+        for child in node.children:
+            self.visit(child)
+
+
+def _label(node):
+    if type(node).__repr__ is not object.__repr__:
+        return repr(node)
+    label = type(node).__name__
+    if isinstance(node, (Map, Chain)) or type(node) is Pair:
+        label += f" {getattr(node.f, '__qualname__', node.f)}"
+    if isinstance(node, Lazy) and node.left_recursive:
+        label += " left_recursive"
+    if isinstance(node, Many) and node.min:
+        label += f" min={node.min}"
+    if node.desc is not None:
+        label += f" {node.desc!r}"
+    return label
+
+
+def pformat(parser, indent=2):
+    lines = []
+    names = {}
+
+    def walk(node, depth):
+        pad = " " * (indent * depth)
+        if isinstance(node, Lazy):
+            if node in names:
+                lines.append(f"{pad}<{names[node]}>")
+                return
+            names[node] = f"#{len(names) + 1}"
+            lines.append(f"{pad}{_label(node)} {names[node]}")
+        else:
+            lines.append(pad + _label(node))
+        for child in node.children:
+            walk(child, depth + 1)
+
+    walk(parser, 0)
+    return "\n".join(lines)
+
+
+_INF = float("inf")
+
+
+def _nodes(root, resolve=True):
+    nodes = []
+    seen = set()
+    targets = {}
+    queue = deque([root])
+    while queue:
+        node = queue.popleft()
+        if node in seen:
+            continue
+        seen.add(node)
+        nodes.append(node)
+        if isinstance(node, Lazy):
+            if resolve:
+                targets[node] = node.thunk()
+                queue.append(targets[node])
+        else:
+            queue.extend(node.children)
+    return nodes, targets
+
+
+@lru_cache(maxsize=None)
+def _regexp_min_width(pattern, flags):
+    return _sre_parse.parse(pattern, flags).getwidth()[0]
+
+
+# Lower bound on the input a node consumes when it succeeds. Nodes whose
+# behaviour can't be analyzed (user closures, Chain continuations, unresolved
+# Lazy rules) count as `unknown`: 0 gives a safe lower bound, infinity keeps
+# only derivations made of known nodes.
+def _min_size(node, sizes, targets, unknown=0):
+    if isinstance(node, Lazy):
+        return sizes[targets[node]] if node in targets else unknown
+    children = [sizes[child] for child in node.children]
+    match node:
+        case String(s=s):
+            return len(s)
+        case Bytes(b=b):
+            return len(b)
+        case Take(n=n):
+            return n
+        case Struct():
+            return node.struct.size
+        case RegExp():
+            return _regexp_min_width(node.pattern.pattern, node.pattern.flags)
+        case Satisfy() | OneOf():
+            return 1
+        case TakeWhile():
+            return node.min
+        case Error():
+            return _INF
+        case Many():
+            return children[0] if node.min else 0
+        case Return() | EOF():
+            return 0
+        case Lookahead():
+            return 0 if children[0] < _INF else _INF
+        case Alt() | Or():
+            return min(children, default=_INF)
+        case Seq() | Pair() | LengthPrefixed():
+            return sum(children)
+        case Chain():
+            return children[0] + unknown
+        case Map() | Recognize() | Locate() | Deferred() | Cached():
+            return children[0]
+        case _:
+            return unknown
+
+
+def _min_sizes(nodes, targets, unknown=0):
+    sizes = dict.fromkeys(nodes, _INF)
+    changed = True
+    while changed:
+        changed = False
+        for node in reversed(nodes):
+            size = _min_size(node, sizes, targets, unknown)
+            if size < sizes[node]:
+                sizes[node] = size
+                changed = True
+    return sizes
+
+
+_CATEGORY_SOURCE = {
+    _sre.CATEGORY_DIGIT: r"\d",
+    _sre.CATEGORY_NOT_DIGIT: r"\D",
+    _sre.CATEGORY_SPACE: r"\s",
+    _sre.CATEGORY_NOT_SPACE: r"\S",
+    _sre.CATEGORY_WORD: r"\w",
+    _sre.CATEGORY_NOT_WORD: r"\W",
+}
+
+
+class _Unsupported(Exception):
+    pass
+
+
+# Regular expression source for a parsed pattern. Assertions and anchors are
+# dropped and back-references match anything, so the language can only grow.
+# With prefix=True the result matches every prefix of a string the pattern
+# matches.
+def _regex_source(items, prefix=False):
+    parts = [_regex_item(op, av) for op, av in items]
+    if not prefix:
+        return "".join(parts)
+    alternatives = [
+        "".join(parts[:k]) + _regex_item(*items[k], prefix=True)
+        for k in range(len(items))
+    ]
+    return "(?:" + "|".join(alternatives or [""]) + ")"
+
+
+def _regex_item(op, av, prefix=False):
+    if op is _sre.LITERAL:
+        source = re.escape(chr(av))
+    elif op is _sre.NOT_LITERAL:
+        source = f"[^{re.escape(chr(av))}]"
+    elif op is _sre.ANY:
+        source = "."
+    elif op is _sre.IN:
+        source = "[" + "".join(_class_item(item, value) for item, value in av) + "]"
+    elif op is _sre.BRANCH:
+        branches = [_regex_source(branch, prefix) for branch in av[1]]
+        return "(?:" + "|".join(branches) + ")"
+    elif op is _sre.SUBPATTERN:
+        if av[1] or av[2]:
+            raise _Unsupported()
+        return "(?:" + _regex_source(av[-1], prefix) + ")"
+    elif op is getattr(_sre, "ATOMIC_GROUP", None):
+        return "(?:" + _regex_source(av, prefix) + ")"
+    elif op in _REPEATS:
+        lo, hi, p = av
+        bound = "{%d,%s}" % (0 if prefix else lo, "" if hi == _sre.MAXREPEAT else hi)
+        source = "(?:" + _regex_source(p) + ")" + bound
+        if prefix:
+            source += "(?:" + _regex_source(p, True) + ")"
+        return source
+    elif op in (_sre.AT, _sre.ASSERT, _sre.ASSERT_NOT):
+        return ""
+    elif op is _sre.GROUPREF:
+        return "(?s:.*)"
+    else:
+        raise _Unsupported()
+    return f"(?:{source})?" if prefix else source
+
+
+def _class_item(op, av):
+    if op is _sre.NEGATE:
+        return "^"
+    if op is _sre.LITERAL:
+        return re.escape(chr(av))
+    if op is _sre.RANGE:
+        return re.escape(chr(av[0])) + "-" + re.escape(chr(av[1]))
+    if op is _sre.CATEGORY and av in _CATEGORY_SOURCE:
+        return _CATEGORY_SOURCE[av]
+    raise _Unsupported()
+
+
+@lru_cache(maxsize=None)
+def _regexp_prefix(pattern, flags):
+    try:
+        source = _regex_source(_sre_parse.parse(pattern, flags), prefix=True)
+    except _Unsupported:
+        return None
+    if isinstance(pattern, bytes):
+        source = source.encode("latin-1")
+    return re.compile(source, flags & ~re.VERBOSE)
+
+
+# Sources for the characters a pattern's match can start with, and whether
+# it can match empty input.
+def _regex_first(items):
+    firsts = []
+    for op, av in items:
+        if op in (_sre.LITERAL, _sre.NOT_LITERAL, _sre.ANY, _sre.IN):
+            return firsts + [_regex_item(op, av)], False
+        if op is _sre.BRANCH:
+            branches = [_regex_first(branch) for branch in av[1]]
+            item = [first for branch, _ in branches for first in branch]
+            nullable = any(nullable for _, nullable in branches)
+        elif op is _sre.SUBPATTERN:
+            if av[1] or av[2]:
+                raise _Unsupported()
+            item, nullable = _regex_first(av[-1])
+        elif op is getattr(_sre, "ATOMIC_GROUP", None):
+            item, nullable = _regex_first(av)
+        elif op in _REPEATS:
+            item, nullable = _regex_first(av[2])
+            nullable = nullable or av[0] == 0
+        elif op in (_sre.AT, _sre.ASSERT, _sre.ASSERT_NOT):
+            continue
+        else:
+            raise _Unsupported()
+        firsts += item
+        if not nullable:
+            return firsts, False
+    return firsts, True
+
+
+@lru_cache(maxsize=None)
+def _regexp_first(pattern, flags):
+    try:
+        firsts, _ = _regex_first(_sre_parse.parse(pattern, flags))
+    except _Unsupported:
+        return None
+    scoped = "".join(c for flag, c in ((re.I, "i"), (re.S, "s")) if flags & flag)
+    return f"(?{scoped}:" + "|".join(firsts or ["(?!)"]) + ")"
+
+
+# Source for the characters a non-empty match of the node can start with, or
+# None if it can match empty input or starts with something that can't be
+# described.
+def _first_source(root, binary, targets, sizes):
+    if sizes[root] == 0:
+        return None
+    sources = []
+    seen = set()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node in seen:
+            continue
+        seen.add(node)
+        match node:
+            case Lazy():
+                stack.append(targets[node])
+            case String(s=s) if not binary:
+                sources.append(re.escape(s))
+            case Bytes(b=b) if binary:
+                sources.append(re.escape(b.decode("latin-1")))
+            case RegExp() if isinstance(node.pattern.pattern, bytes) == binary:
+                source = _regexp_first(node.pattern.pattern, node.pattern.flags)
+                if source is None:
+                    return None
+                sources.append(source)
+            case OneOf() if node.binary == binary:
+                sources.append(_char_class(node.chars, node.invert))
+            case TakeWhile() if node.binary == binary:
+                sources.append(_char_class(node.chars))
+            case Return() | Error() | EOF():
+                pass
+            case Seq() | Pair() | Many():
+                for child in node.children:
+                    stack.append(child)
+                    if sizes[child] > 0:
+                        break
+            case Chain():
+                if sizes[node.p] == 0:
+                    return None
+                stack.append(node.p)
+            case Alt() | Or() | Lookahead() | Map() | Recognize():
+                stack.extend(node.children)
+            case Locate() | Deferred() | Cached():
+                stack.extend(node.children)
+            case _:
+                return None
+    return "(?:" + "|".join(sources or ["(?!)"]) + ")"
+
+
+@lru_cache(maxsize=None)
+def _regexp_scan_source(pattern, flags):
+    if flags & re.LOCALE:
+        return "", False, True
+    try:
+        source = _regex_source(_sre_parse.parse(pattern, flags))
+    except _Unsupported:
+        first = _regexp_first(pattern, flags)
+        return ("", False, True) if first is None else (first, False, True)
+    scoped = "".join(c for flag, c in ((re.I, "i"), (re.S, "s")) if flags & flag)
+    source = f"(?{scoped}:{source})"
+    # Measured on the derived source, where back-references became `.*`.
+    lo, hi = _sre_parse.parse(source).getwidth()
+    return source, True, lo == hi
+
+
+# Regex source matching a prefix of every successful match of the node, with
+# whether it describes whole matches and whether it is free of unbounded
+# repetition. Sequences and Many stop after an unbounded part, so the
+# prefilter never chains or nests quantifiers that could backtrack. Recursive
+# rules are cut off at their first characters.
+def _scan_source(node, binary, targets, sizes, memo, active):
+    if isinstance(node, Lazy):
+        if node in memo:
+            return memo[node]
+        if node in active:
+            first = _first_source(node, binary, targets, sizes)
+            return ("", False, True) if first is None else (first, False, True)
+        active.add(node)
+        memo[node] = _scan_source(targets[node], binary, targets, sizes, memo, active)
+        active.discard(node)
+        return memo[node]
+    children = [
+        lambda child=child: _scan_source(child, binary, targets, sizes, memo, active)
+        for child in node.children
+    ]
+    match node:
+        case String(s=s):
+            return ("(?!)" if binary else re.escape(s)), True, True
+        case Bytes(b=b):
+            return (re.escape(b.decode("latin-1")) if binary else "(?!)"), True, True
+        case RegExp() if isinstance(node.pattern.pattern, bytes) == binary:
+            return _regexp_scan_source(node.pattern.pattern, node.pattern.flags)
+        case OneOf() if node.binary == binary:
+            return _char_class(node.chars, node.invert), True, True
+        case TakeWhile() if node.binary == binary:
+            return _char_class(node.chars) + ("+" if node.min else "*"), True, False
+        case Satisfy():
+            return "(?s:.)", True, True
+        case Take(n=n):
+            return "(?s:.{%d})" % n, True, True
+        case Struct():
+            return "(?s:.{%d})" % node.struct.size, True, True
+        case Return() | EOF():
+            return "", True, True
+        case Error():
+            return "(?!)", True, True
+        case Seq() | Pair():
+            parts = []
+            for child in children:
+                source, complete, bounded = child()
+                parts.append(source)
+                if not bounded:
+                    return "".join(parts), False, False
+                if not complete:
+                    return "".join(parts), False, True
+            return "".join(parts), True, True
+        case Alt() | Or():
+            results = [child() for child in children]
+            return (
+                "(?:" + "|".join(source for source, _, _ in results) + ")",
+                all(complete for _, complete, _ in results),
+                all(bounded for _, _, bounded in results),
+            )
+        case Many():
+            source, complete, bounded = children[0]()
+            if not bounded:
+                complete = False
+            elif complete:
+                rest, rest_complete, rest_bounded = children[-1]()
+                if rest_complete and rest_bounded:
+                    source, bounded = f"{source}(?:{rest})*", False
+                else:
+                    source, complete = f"{source}(?:{rest})?", False
+                    bounded = bounded and rest_bounded
+            return (source if node.min else f"(?:{source})?"), complete, bounded
+        case Lookahead():
+            source, _, bounded = children[0]()
+            return f"(?={source})", True, bounded
+        case Chain() | LengthPrefixed():
+            source, _, bounded = children[0]()
+            return source, False, bounded
+        case Map() | Recognize() | Locate() | Deferred() | Cached():
+            return children[0]()
+        case _:
+            return "", False, True
+
+
+# A regex whose matches start wherever the parser could match non-empty
+# input, or None if it would match everywhere.
+def _scan_prefilter(root, binary):
+    nodes, targets = _nodes(root)
+    sizes = _min_sizes(nodes, targets, 0)
+    source, _, _ = _scan_source(root, binary, targets, sizes, {}, set())
+    if binary:
+        source = source.encode("latin-1")
+    prefilter = re.compile(source)
+    if prefilter.fullmatch(b"" if binary else "") is not None:
+        return None
+    return prefilter
+
+
+# Sources for every character a pattern can match.
+def _regex_alphabet(items):
+    chars = []
+    for op, av in items:
+        if op in (_sre.LITERAL, _sre.NOT_LITERAL, _sre.ANY, _sre.IN):
+            chars.append(_regex_item(op, av))
+        elif op is _sre.BRANCH:
+            for branch in av[1]:
+                chars += _regex_alphabet(branch)
+        elif op is _sre.SUBPATTERN:
+            if av[1] or av[2]:
+                raise _Unsupported()
+            chars += _regex_alphabet(av[-1])
+        elif op is getattr(_sre, "ATOMIC_GROUP", None):
+            chars += _regex_alphabet(av)
+        elif op in _REPEATS:
+            chars += _regex_alphabet(av[2])
+        elif op not in (_sre.AT, _sre.ASSERT, _sre.ASSERT_NOT, _sre.GROUPREF):
+            raise _Unsupported()
+    return chars
+
+
+# Sources for the characters that end a match, such as a closing quote, or
+# None if every match ends in a repetition.
+def _regex_closers(items):
+    items = [(op, av) for op, av in items if op not in (_sre.AT, _sre.ASSERT_NOT)]
+    if not items:
+        return None
+    op, av = items[-1]
+    if op in (_sre.LITERAL, _sre.NOT_LITERAL, _sre.ANY, _sre.IN):
+        return [_regex_item(op, av)]
+    if op is _sre.SUBPATTERN and not av[1] and not av[2]:
+        return _regex_closers(av[-1])
+    if op is _sre.BRANCH:
+        closers = [_regex_closers(branch) for branch in av[1]]
+        closers = [c for branch in closers if branch is not None for c in branch]
+        return closers or None
+    return None
+
+
+# Regexes telling whether text appended to a long token might still belong to
+# it: every character is in the pattern's alphabet and none can close it.
+@lru_cache(maxsize=None)
+def _regexp_stream(pattern, flags):
+    if flags & re.LOCALE:
+        return None
+    try:
+        items = _sre_parse.parse(pattern, flags)
+        alphabet = _regex_alphabet(items)
+        closers = _regex_closers(items)
+    except _Unsupported:
+        return None
+    scoped = "".join(c for flag, c in ((re.I, "i"), (re.S, "s")) if flags & flag)
+    sources = [
+        f"(?{scoped}:(?:" + "|".join(alphabet or ["(?!)"]) + ")*)",
+        None if closers is None else f"(?{scoped}:" + "|".join(closers) + ")",
+    ]
+    if isinstance(pattern, bytes):
+        sources = [s if s is None else s.encode("latin-1") for s in sources]
+    return tuple(s if s is None else re.compile(s) for s in sources)
+
+
+class GrammarError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class GrammarInfo:
+    nullable: frozenset
+    never: frozenset
+
+
+# Sizes of a node with Lazy rules left unresolved, as (lower, known). Without
+# Lazy the grammar is a DAG of nodes built earlier, so each node is computed
+# once from its children and kept for the nodes built on top of it.
+_LOCAL_SIZES = weakref.WeakKeyDictionary()
+
+
+def _local_sizes(root):
+    stack = [root]
+    while stack:
+        node = stack[-1]
+        if node in _LOCAL_SIZES:
+            stack.pop()
+            continue
+        children = () if isinstance(node, Lazy) else node.children
+        pending = [child for child in children if child not in _LOCAL_SIZES]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        lower = {child: _LOCAL_SIZES[child][0] for child in children}
+        known = {child: _LOCAL_SIZES[child][1] for child in children}
+        _LOCAL_SIZES[node] = (
+            _min_size(node, lower, {}, 0),
+            _min_size(node, known, {}, _INF),
+        )
+    return _LOCAL_SIZES[root]
+
+
+def _check_many(many):
+    lower, known = _local_sizes(many.p)
+    if known == 0:
+        raise GrammarError(f"Parser must consume: {many.p!r} can match empty input.")
+    if lower > 0:
+        many.consumes = True
+
+
+def analyze(parser):
+    nodes, targets = _nodes(parser)
+    lower = _min_sizes(nodes, targets, 0)
+    known = _min_sizes(nodes, targets, _INF)
+    loops = frozenset(
+        node for node in nodes if isinstance(node, Many) and known[node.p] == 0
+    )
+    if loops:
+        raise GrammarError(
+            "Parser must consume: "
+            + ", ".join(repr(node.p) for node in loops)
+            + " can match empty input."
+        )
+    for node in nodes:
+        if isinstance(node, Many) and lower[node.p] > 0:
+            node.consumes = True
+    return GrammarInfo(
+        nullable=frozenset(node for node in nodes if lower[node] == 0),
+        never=frozenset(node for node in nodes if lower[node] == _INF),
+    )
+
+
+_PRINTABLE = [chr(c) for c in range(32, 127)]
+_CATEGORIES = {
+    _sre.CATEGORY_DIGIT: "0123456789",
+    _sre.CATEGORY_SPACE: " \t\n",
+    _sre.CATEGORY_WORD: "".join(c for c in _PRINTABLE if c.isalnum() or c == "_"),
+}
+_CATEGORIES[_sre.CATEGORY_NOT_DIGIT] = "".join(
+    c for c in _PRINTABLE if c not in _CATEGORIES[_sre.CATEGORY_DIGIT]
+)
+_CATEGORIES[_sre.CATEGORY_NOT_SPACE] = "".join(
+    c for c in _PRINTABLE if c not in _CATEGORIES[_sre.CATEGORY_SPACE]
+)
+_CATEGORIES[_sre.CATEGORY_NOT_WORD] = "".join(
+    c for c in _PRINTABLE if c not in _CATEGORIES[_sre.CATEGORY_WORD]
+)
+_REPEATS = tuple(
+    getattr(_sre, name)
+    for name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT")
+    if hasattr(_sre, name)
+)
+
+
+def _in_class(items, c):
+    for op, av in items:
+        if op is _sre.LITERAL and c == chr(av):
+            return True
+        if op is _sre.RANGE and av[0] <= ord(c) <= av[1]:
+            return True
+        if op is _sre.CATEGORY and c in _CATEGORIES.get(av, ""):
+            return True
+    return False
+
+
+class _Generator(Visitor):
+    def __init__(self, root, size, rng, max_depth, avg_repeat):
+        super().__init__()
+        self.size = size
+        self.rng = rng
+        self.max_depth = max_depth
+        self.repeat = 1 - 1 / avg_repeat
+        nodes, self.targets = _nodes(root)
+        self.sizes = _min_sizes(nodes, self.targets)
+        self.driver = next(
+            (
+                node
+                for node in nodes
+                if isinstance(node, Many) and self.sizes[node.p] < _INF
+            ),
+            None,
+        )
+        self.regexps = {}
+        self.classes = {}
+
+    def run(self, root):
+        if self.sizes[root] == _INF:
+            raise ValueError("Grammar cannot match any input.")
+        self.out = []
+        self.length = 0
+        self.depth = 0
+        self.minimal = 0
+        self.driving = False
+        self.visit(root)
+        if any(isinstance(piece, bytes) for piece in self.out):
+            return b"".join(self.out)
+        return "".join(self.out)
+
+    def emit(self, piece):
+        self.out.append(piece)
+        self.length += len(piece)
+
+    def exhausted(self):
+        return self.minimal > 0 or self.length >= self.size
+
+    def choose(self, options):
+        options = [p for p in options if self.sizes[p] < _INF]
+        if self.exhausted():
+            return min(options, key=self.sizes.__getitem__)
+        return self.rng.choice(options)
+
+    def count(self, lo, hi):
+        n = lo
+        if not self.exhausted():
+            while n < hi and self.rng.random() < self.repeat:
+                n += 1
+        return n
+
+    def generic_visit(self, node):
+        raise TypeError(f"Cannot generate input for {node!r}.")
+
+    def visit_child(self, node):
+        self.visit(node.p)
+
+    visit_Map = visit_Recognize = visit_Locate = visit_Deferred = visit_child
+    visit_Cached = visit_child
+
+    def visit_nothing(self, node):
+        pass
+
+    visit_Return = visit_EOF = visit_Lookahead = visit_nothing
+
+    def visit_Seq(self, node):
+        for child in node.children:
+            self.visit(child)
+
+    visit_Pair = visit_Then = visit_Skip = visit_Seq
+
+    def visit_Alt(self, node):
+        self.visit(self.choose(node.children))
+
+    visit_Or = visit_Alt
+
+    def visit_Many(self, node):
+        if node.head is not None or node.min:
+            first = node.children[0]
+            if not node.min and (self.sizes[first] == _INF or not self.count(0, 1)):
+                return
+            self.visit(first)
+        if self.sizes[node.p] == _INF:
+            return
+        if node is self.driver and not self.driving:
+            self.driving = True
+            try:
+                while not self.exhausted():
+                    length = self.length
+                    self.visit(node.p)
+                    if self.length == length:
+                        break
+            finally:
+                self.driving = False
+            return
+        for _ in range(self.count(0, _INF)):
+            self.visit(node.p)
+
+    def visit_Lazy(self, node):
+        self.depth += 1
+        deep = self.depth > self.max_depth
+        self.minimal += deep
+        try:
+            self.visit(self.targets[node])
+        finally:
+            self.minimal -= deep
+            self.depth -= 1
+
+    def visit_Chain(self, node):
+        start = len(self.out)
+        self.visit(node.p)
+        text = ("" if start == len(self.out) else self.out[start][:0]).join(
+            self.out[start:]
+        )
+        match node.p(text)[0]:
+            case COk(value) | EOk(value):
+                self.visit(node.f(_force(value)))
+            case _:
+                raise ValueError(f"Generated {text!r} is not accepted by {node.p!r}.")
+
+    def visit_LengthPrefixed(self, node):
+        if not isinstance(node.length, Struct):
+            raise TypeError("Length prefixes must be Struct parsers.")
+        out, length = self.out, self.length
+        self.out = []
+        self.visit(node.p)
+        inner = b"".join(self.out)
+        self.out, self.length = out, length
+        self.emit(node.length.struct.pack(len(inner)))
+        self.emit(inner)
+
+    def visit_String(self, node):
+        self.emit(node.s)
+
+    def visit_Bytes(self, node):
+        self.emit(node.b)
+
+    def visit_Take(self, node):
+        self.emit(self.rng.randbytes(node.n))
+
+    def visit_Struct(self, node):
+        self.emit(self.rng.randbytes(node.struct.size))
+
+    def visit_Satisfy(self, node):
+        chars = [c for c in _PRINTABLE if node.pred(c)]
+        if not chars:
+            raise ValueError(f"Cannot find a character accepted by {node!r}.")
+        self.emit(self.rng.choice(chars))
+
+    def visit_OneOf(self, node):
+        members = {chr(c) for c in node.chars} if node.binary else node.chars
+        if node.invert:
+            chars = [c for c in _PRINTABLE if c not in members]
+        else:
+            chars = sorted(members)
+        self.emit_chars(node, self.rng.choice(chars))
+
+    def visit_TakeWhile(self, node):
+        chars = sorted(map(chr, node.chars) if node.binary else node.chars)
+        n = self.count(node.min, _INF)
+        self.emit_chars(node, "".join(self.rng.choice(chars) for _ in range(n)))
+
+    def emit_chars(self, node, text):
+        self.emit(text.encode("latin-1") if node.binary else text)
+
+    def visit_RegExp(self, node):
+        pattern = node.pattern
+        if node not in self.regexps:
+            self.regexps[node] = _sre_parse.parse(pattern.pattern, pattern.flags)
+        out = []
+        self.sample(self.regexps[node], out, {})
+        text = "".join(out)
+        if isinstance(pattern.pattern, bytes):
+            text = text.encode("latin-1")
+        self.emit(text)
+
+    def sample(self, items, out, groups):
+        for op, av in items:
+            if op is _sre.LITERAL:
+                out.append(chr(av))
+            elif op is _sre.NOT_LITERAL:
+                out.append(self.rng.choice([c for c in _PRINTABLE if ord(c) != av]))
+            elif op is _sre.ANY:
+                out.append(self.rng.choice(_PRINTABLE))
+            elif op is _sre.IN:
+                out.append(self.sample_class(av))
+            elif op is _sre.BRANCH:
+                self.sample(self.rng.choice(av[1]), out, groups)
+            elif op is _sre.SUBPATTERN:
+                start = len(out)
+                self.sample(av[-1], out, groups)
+                if av[0] is not None:
+                    groups[av[0]] = "".join(out[start:])
+            elif op in _REPEATS:
+                lo, hi, p = av
+                for _ in range(self.count(lo, hi)):
+                    self.sample(p, out, groups)
+            elif op is _sre.GROUPREF:
+                out.append(groups.get(av, ""))
+            elif op is getattr(_sre, "ATOMIC_GROUP", None):
+                self.sample(av, out, groups)
+            elif op in (_sre.AT, _sre.ASSERT, _sre.ASSERT_NOT):
+                pass
+            else:
+                raise ValueError(f"Cannot sample regular expression operator {op}.")
+
+    def sample_class(self, items):
+        if items and items[0][0] is _sre.NEGATE:
+            # Parsed patterns are kept in self.regexps, so ids stay unique.
+            chars = self.classes.get(id(items))
+            if chars is None:
+                chars = [c for c in _PRINTABLE if not _in_class(items[1:], c)]
+                self.classes[id(items)] = chars
+            return self.rng.choice(chars)
+        op, av = self.rng.choice(items)
+        if op is _sre.LITERAL:
+            return chr(av)
+        if op is _sre.RANGE:
+            return chr(self.rng.randint(*av))
+        if op is _sre.CATEGORY:
+            return self.rng.choice(_CATEGORIES[av])
+        raise ValueError(f"Cannot sample character class item {op}.")
+
+
+def generate(parser, size=1000, seed=None, max_depth=20, avg_repeat=3, attempts=10):
+    generator = _Generator(parser, size, random.Random(seed), max_depth, avg_repeat)
+    best = None
+    for _ in range(attempts):
+        output = generator.run(parser)
+        if best is None or len(output) > len(best):
+            best = output
+        if len(best) >= size:
+            break
+    return best
+
+
+def parse_many_threaded(parser, sources, max_workers=None):
+    with ThreadPoolExecutor(max_workers) as executor:
+        return list(executor.map(parser, sources))
+
+
+def located(p):
+    return p.located()
+
+
+def take(n):
+    return Take(n)
+
+
+def length_prefixed(p, length=None):
+    return LengthPrefixed(p, u32be if length is None else length)
+
+
+u8 = Struct("B")
+i8 = Struct("b")
+u16le = Struct("<H")
+u16be = Struct(">H")
+i16le = Struct("<h")
+i16be = Struct(">h")
+u32le = Struct("<I")
+u32be = Struct(">I")
+i32le = Struct("<i")
+i32be = Struct(">i")
+u64le = Struct("<Q")
+u64be = Struct(">Q")
+i64le = Struct("<q")
+i64be = Struct(">q")
+f32le = Struct("<f")
+f32be = Struct(">f")
+f64le = Struct("<d")
+f64be = Struct(">d")
+
 opt_whitespace = RegExp("\\s*")
@@ -0,0 +1,106 @@
+from pyrsec import (
+    State,
+    Parser,
+    Bytes,
+    Struct,
+    EOF,
+    COk,
+    CErr,
+    EErr,
+    take,
+    length_prefixed,
+    u8,
+    u16le,
+    u32be,
+    f64le,
+    CacheInfo,
+    EOk,
+    one_of,
+    none_of,
+    take_while1,
+    generate,
+)
+import struct
+
+record = Parser.seq(
+    Bytes(b"REC"),
+    u8,
+    u16le,
+    length_prefixed(take(2).many(), length=u8),
+    f64le,
+)
+
+
+def test_bytes():
+    state = State(memoryview(b"abcd"))
+    result, new_state = Bytes(b"ab")(state)
+    assert result == COk(b"ab") and new_state == state.advance(2)
+    result, new_state = Bytes(b"b")(state)
+    assert result == EErr() and new_state == state
+
+
+def test_take():
+    result, state = take(3)(b"abcd")
+    assert isinstance(result.value, memoryview)
+    assert result.value == b"abc" and state.i == 3
+    result, state = take(5)(b"abcd")
+    assert result == EErr() and state.i == 0
+
+
+def test_struct():
+    assert u8(b"\xff")[0] == COk(255)
+    assert u16le(b"\x01\x02")[0] == COk(0x0201)
+    assert u32be(b"\x00\x00\x01\x00")[0] == COk(256)
+    assert u32be(b"\x00\x00\x01")[0] == EErr()
+    assert Struct("<BH")(b"\x01\x02\x00")[0] == COk((1, 2))
+    result, state = Struct("")(b"ab")
+    assert result == EOk(()) and state.i == 0
+
+
+def test_byte_sets():
+    token = one_of(b"ab").pair(take_while1(b"0123456789"))
+    result, state = token(b"a12x")
+    assert result.value[0] == ord("a") and result.value[1] == b"12" and state.i == 3
+    assert token(b"c1")[0] == EErr()
+    assert none_of(b"ab")(b"c")[0] == COk(ord("c"))
+    assert repr(one_of(b"ba")) == "OneOf(b'ab', invert=False)"
+    assert [span for span, _ in token.scan(b"x a1 b22 c3")] == [(2, 4), (5, 8)]
+    source = generate(token, seed=1)
+    assert isinstance(source, bytes) and token(source)[0] != EErr()
+
+
+def test_length_prefixed():
+    p = length_prefixed(take(1).many(), length=u8)
+    result, state = p(b"\x02abc")
+    assert [bytes(x) for x in result.value] == [b"a", b"b"] and state.i == 3
+    result, state = p(b"\x05abc")
+    assert result == CErr() and state.i == 0
+    result, _ = length_prefixed(Bytes(b"a"), length=u8)(b"\x02ab")
+    assert result == CErr()
+
+
+def test_record():
+    source = b"REC" + struct.pack("<BH", 7, 513) + b"\x04abcd" + struct.pack("<d", 1.5)
+    result, state = record.skip(EOF())(source)
+    magic, a, b, pairs, x = result.value
+    assert (magic, a, b, x) == (b"REC", 7, 513, 1.5)
+    assert [bytes(pair) for pair in pairs] == [b"ab", b"cd"]
+    assert state.i == len(source)
+    assert record(source[:-1])[0] == CErr()
+
+
+def test_cached():
+    cached = take(4).cached(max_bytes=1 << 20)
+    buffer = bytearray(b"abcd")
+    assert cached(buffer)[0] == COk(b"abcd")
+    buffer[0:1] = b"x"
+    assert cached(buffer)[0] == COk(b"xbcd")
+    assert cached.cache.info() == CacheInfo(0, 0, 0, 0)
+    data = bytes(1 << 16)
+    cached(data)
+    cached(data)
+    info = cached.cache.info()
+    assert (info.hits, info.misses, info.size) == (1, 1, 1)
+    assert 1 << 16 < info.nbytes < (1 << 16) + 1024
+    cached(bytes(2 << 20))
+    assert cached.cache.info().size == 1
@@ -7,6 +7,7 @@ from pyrsec import (
     Parser,
     RegExp,
     String,
+    generate,
 )
 import pytest
 import ast
@@ -555,3 +556,24 @@ def test_expr(source):
 #     x = expr(source)[0].value
 #     y = ast.parse(source, mode="eval")
 #     assert are_equal(x, y)
+
+
+left_access = Lazy(
+    lambda: left_access.pair(
+        property, lambda value, prop: access_map(value, [prop])
+    ).or_(primary),
+    left_recursive=True,
+)
+
+
+@pytest.mark.parametrize("source", ["a", "a.b[c](d)", "f(x, y)(z).w[1 + 2]", "(a).b.c"])
+def test_left_recursive_access(source):
+    x = left_access(source)[0].value
+    y = ast.parse(source, mode="eval").body
+    assert are_equal(x, y)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_generate(seed):
+    source = generate(expr, size=300, seed=seed)
+    assert len(source) >= 300 and expr.validate(source)
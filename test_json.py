@@ -11,8 +11,14 @@ from pyrsec import (
     EOk,
     CErr,
     EErr,
+    parse_many_threaded,
+    CacheInfo,
+    generate,
+    NeedMore,
 )
+from concurrent.futures import ThreadPoolExecutor
 from json import dumps, loads
+import sys
 
 opt_whitespace = RegExp("\\s*")
 
@@ -76,3 +82,123 @@ def test_object():
 }
 """
     assert dumps(json(source)[0].value) == dumps(loads(source))
+
+
+def test_validate():
+    source = '{"a": [1.0, true, {"b": null}], "c": "d"} '
+    assert json.validate(source)
+    assert not json.validate(source + "x")
+    assert not json.validate('{"a": [1.0, true}')
+    result, _ = json.recognize()(source)
+    assert result.value == source
+
+
+def test_deferred():
+    source = '{"a": [1.0, true, {"b": null}], "c": "d"}'
+    assert json.deferred()(source)[0].value == loads(source)
+
+
+def test_parse_many_threaded():
+    sources = ['{"a": [%d.0, true], "b": "%d"}' % (i, i) for i in range(50)]
+    results = parse_many_threaded(json, sources, max_workers=4)
+    assert [result.value for result, _ in results] == [loads(s) for s in sources]
+
+
+def test_shared_grammar_modes():
+    source = '{"a": [1.0, true, {"b": null}], "c": "d"}'
+    parsers = [json, json.recognize(), json.deferred()] * 20
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda p: p(source)[0].value, parsers))
+    for i, value in enumerate(results):
+        assert value == (source if i % 3 == 1 else loads(source))
+
+
+def test_iter_sep_by():
+    source = "[" + ", ".join(f'{{"i": {i}.0}}' for i in range(1000)) + "] "
+    result, state = lbrak(source)
+    items = value.iter_sep_by(comma, state)
+    for i, item in enumerate(items):
+        assert item == {"i": float(i)}
+        if i == 10:
+            break
+    items = value.iter_sep_by(comma, state)
+    assert sum(1 for _ in items) == 1000
+    items = value.iter_sep_by(comma, state)
+    try:
+        while True:
+            next(items)
+    except StopIteration as stop:
+        result, state = stop.value
+    assert result == COk(None)
+    assert rbrak.then(EOF())(state)[0] == COk(None)
+
+    chunks = (source[i : i + 7] for i in range(1, len(source), 7))
+    result, state = lbrak(source[:1])
+    items = value.iter_sep_by(comma, state, chunks)
+    values = []
+    try:
+        while True:
+            values.append(next(items))
+    except StopIteration as stop:
+        result, state = stop.value
+    assert values == [{"i": float(i)} for i in range(1000)] and result == COk(None)
+    # Only the input after the last element is still buffered.
+    assert len(state.source) < 32
+    assert rbrak.then(EOF())(state)[0] == COk(None)
+
+
+def test_cached():
+    source = '{"a": [1.0, true, {"b": null}], "c": "d"}'
+    cached = json.cached(maxsize=2)
+    first, state = cached(source)
+    second, state = cached(source)
+    assert first == second and second.value is first.value
+    assert state.i == len(source) and state.ctx is not None
+    info = cached.cache.info()
+    assert (info.hits, info.misses, info.size) == (1, 1, 1)
+    assert info.nbytes > sys.getsizeof(source)
+    cached("[1.0]")
+    cached("[2.0]")
+    cached(source)
+    assert cached.cache.info().misses == 4
+    assert cached("x")[0] == EErr() and cached.cache.info().size == 2
+
+    copying = json.cached(copy=True)
+    value = copying(source)[0].value
+    value["a"].append(2.0)
+    assert copying(source)[0].value == loads(source)
+
+    small = json.cached(max_bytes=info.nbytes + 10)
+    small(source)
+    small("[1.0]")
+    assert small.cache.info().size == 1
+    expanding = lbrak.map(lambda _: list(range(10000))).cached(max_bytes=10000)
+    expanding("[")
+    assert expanding.cache.info().size == 0
+
+    misses = cached.cache.info().misses
+    assert opt_whitespace.then(cached)(" " + source)[0].value == loads(source)
+    assert cached.cache.info().misses == misses
+
+
+def test_generate():
+    for seed in range(10):
+        source = generate(json, size=500, seed=seed)
+        loads(source)
+        assert json.validate(source)
+    assert generate(json, size=500, seed=1) == generate(json, size=500, seed=1)
+    assert len(generate(json, size=20000, seed=2)) >= 20000
+
+
+def test_parse_partial():
+    source = '{"a": [1.0, true, {"b": null}], "c": "d\\n", "e": -12.5e3} '
+    expected = json(source)[0].value
+    document = json.skip(EOF())
+    for n in (1, 3, 16):
+        chunks = [source[i : i + n] for i in range(0, len(source), n)]
+        out = document.parse_partial(chunks[0])
+        for chunk in chunks[1:]:
+            assert isinstance(out, NeedMore)
+            out = out.feed(chunk)
+        result, state = out.finish()
+        assert result.value == expected and state.i == len(source)
@@ -11,8 +11,40 @@ from pyrsec import (
     EOk,
     CErr,
     EErr,
+    satisfy,
+    one_of,
+    none_of,
+    take_while,
+    take_while1,
+    located,
+    Located,
+    Position,
+    opt_whitespace,
+    BudgetExceeded,
+    Alt,
+    Many,
+    Map,
+    Then,
+    Visitor,
+    pformat,
+    generate,
+    Bytes,
+    take,
+    length_prefixed,
+    u8,
+    u16le,
+    Tracer,
+    GrammarError,
+    NeedMore,
+    BatchResult,
+    u16be,
 )
+from array import array
+import contextvars
 import json
+import threading
+import time
+import pytest
 
 
 def test_return():
@@ -146,3 +178,509 @@ def test_balanced_braks():
             result, _ = balanced.skip(EOF())(state)
             z = stringify(result.value)
             assert y == z
+
+
+def test_satisfy():
+    state = State("a1")
+    p = satisfy(str.isalpha)
+    result, new_state = p(state)
+    assert result == COk("a") and new_state == state.advance(1)
+    result, new_state = p(new_state)
+    assert result == EErr() and new_state == state.advance(1)
+    result, new_state = p(State(""))
+    assert result == EErr()
+
+
+def test_one_of():
+    state = State("+-")
+    p = one_of("+-")
+    result, new_state = p(state)
+    assert result == COk("+") and new_state == state.advance(1)
+    result, _ = none_of("+-")(state)
+    assert result == EErr()
+    result, _ = none_of("+-")(State("x"))
+    assert result == COk("x")
+    result, _ = one_of("]^-\\")(State("\\"))
+    assert result == COk("\\")
+
+
+def test_take_while():
+    state = State("aabba-c")
+    p = take_while("ab")
+    result, new_state = p(state)
+    assert result == COk("aabba") and new_state == state.advance(5)
+    result, new_state = p(new_state)
+    assert result == EOk("") and new_state == state.advance(5)
+    result, _ = take_while1("ab")(new_state)
+    assert result == EErr()
+    result, _ = take_while1("-^]")(new_state)
+    assert result == COk("-")
+
+
+def test_recognize():
+    calls = []
+    word = RegExp("[a-z]+").map(lambda x: calls.append(x) or x.upper())
+    words = Parser.seq(word, String(",").then(word).many())
+    result, new_state = words.recognize()("ab,cd,ef!")
+    assert result == COk("ab,cd,ef") and new_state.i == 8
+    assert calls == []
+    result, new_state = words("ab,cd,ef!")
+    assert result == COk(["AB", ["CD", "EF"]]) and calls == ["ab", "cd", "ef"]
+    result, new_state = Return(1).recognize()("ab")
+    assert result == EOk("") and new_state.i == 0
+
+
+def test_validate():
+    word = RegExp("[a-z]+").map(str.upper)
+    words = word.sep_by(String(","))
+    assert words.validate("ab,cd")
+    assert words.validate("")
+    assert not words.validate("ab,cd,")
+    assert not words.validate("ab;cd")
+
+
+def test_validate_dependent():
+    n = RegExp("[0-9]+").map(int)
+    assert n.chain(take).validate("3abc")
+    assert not n.chain(take).validate("3ab")
+    total = Parser.seq(n, String(","), n).chain(lambda xs: Return(xs[0] + xs[2]))
+    assert total.validate("1,2")
+    assert total.recognize()("1,2")[0] == COk("1,2")
+    record = length_prefixed(take(1).many(), length=u8.map(lambda n: n - 1))
+    assert record.validate(b"\x03ab")
+    assert not record.validate(b"\x03abc")
+    assert record.deferred()(b"\x03ab")[0] == COk([b"a", b"b"])
+
+
+def test_deferred():
+    calls = []
+
+    def action(name):
+        return lambda x: calls.append(name) or name
+
+    sign = RegExp("-?")
+    p = Parser.alt(
+        sign.map(action("x")).skip(String("x")),
+        sign.map(action("y")).skip(String("y")),
+    )
+    assert p("y")[0] == COk("y") and calls == ["x", "y"]
+    calls.clear()
+    assert p.deferred()("y")[0] == COk("y") and calls == ["y"]
+    calls.clear()
+    assert p.deferred()("z")[0] == EErr() and calls == []
+
+    number = RegExp("[0-9]+").map(int)
+    numbers = Parser.seq(number, String(",").then(number).many(), Return(None))
+    total = numbers.chain(lambda xs: Return(xs[0] + sum(xs[1])))
+    value = total.skip(String(";")).pair(number.sep_by(String(",")))
+    assert value.deferred()("1,2,3;4,5")[0] == COk((6, [4, 5]))
+    assert value("1,2,3;4,5")[0] == COk((6, [4, 5]))
+
+
+def test_position():
+    state = State("ab\ncd\n\nef")
+    assert state.position() == Position(0, 1, 0)
+    assert state.advance(4).position() == Position(4, 2, 1)
+    assert state.advance(7).position() == Position(7, 4, 0)
+    assert State(memoryview(b"a\nb"), 2).position() == Position(2, 2, 0)
+
+
+def test_located():
+    word = located(RegExp("[a-z]+")).skip(opt_whitespace)
+    result, _ = word.many()("ab\n  cd")
+    assert result == COk(
+        [
+            Located("ab", Position(0, 1, 0), Position(2, 1, 2)),
+            Located("cd", Position(5, 2, 2), Position(7, 2, 4)),
+        ]
+    )
+    upper = located(RegExp("a").map(str.upper)).deferred()
+    assert upper("a")[0] == COk(Located("A", Position(0, 1, 0), Position(1, 1, 1)))
+
+
+def test_iter_many():
+    digits = RegExp("[0-9]")
+    items = digits.iter_many("12a")
+    assert next(items) == "1" and next(items) == "2"
+    try:
+        next(items)
+    except StopIteration as stop:
+        result, state = stop.value
+    assert result == COk(None) and state.i == 2
+    assert list(digits.iter_many("a")) == []
+    assert list(String("ab").iter_sep_by(String(","), "ab,ab,ab")) == ["ab"] * 3
+    items = RegExp("[0-9]+").iter_many("1", ["2", "", "3", "4a", "b"])
+    assert next(items) == "1234"
+    try:
+        next(items)
+    except StopIteration as stop:
+        result, state = stop.value
+    assert result == COk(None) and state.source[state.i :] == "ab"
+    assert list(RegExp(b"[0-9]").iter_many(b"12", [b"3"])) == [b"1", b"2", b"3"]
+
+
+def test_max_steps():
+    p = String("a").many()
+    result, state = p("aaaa", max_steps=100)
+    assert result == COk(["a"] * 4)
+    with pytest.raises(BudgetExceeded) as info:
+        p("a" * 100, max_steps=20)
+    assert info.value.offset == 19 and info.value.steps == 21
+    with pytest.raises(BudgetExceeded):
+        String("a")("a", max_steps=0)
+    state = State("aaa")
+    with pytest.raises(BudgetExceeded):
+        p(state, max_steps=2)
+    assert p(state)[0] == COk(["a"] * 3)
+    ahead = String("a").many().then(String("b")).lookahead()
+    backtracking = Parser.alt(ahead.then(String("b")), String("a"))
+    with pytest.raises(BudgetExceeded) as info:
+        backtracking.many()("a" * 50 + "c", max_steps=150)
+    assert info.value.offset == 50
+
+
+def test_deadline():
+    p = String("a").many()
+    assert p("a" * 1000, deadline=time.monotonic() + 60)[0] == COk(["a"] * 1000)
+    with pytest.raises(BudgetExceeded) as info:
+        p("a" * 1000, deadline=time.monotonic() - 1)
+    assert 0 <= info.value.offset < 1000
+
+
+def test_left_recursion():
+    number = RegExp("[0-9]+").map(int)
+    op = one_of("+-")
+    expr = Lazy(
+        lambda: expr.pair(
+            op.pair(number), lambda x, y: x + y[1] if y[0] == "+" else x - y[1]
+        ).or_(number),
+        left_recursive=True,
+    )
+    assert expr("1-2-3")[0] == COk(-4)
+    assert expr("10-2+3x")[0] == COk(11)
+    assert expr("7")[0] == COk(7)
+    assert expr("x")[0] == EErr()
+    assert expr.validate("1+2-3")
+    assert expr.deferred()("1-2-3")[0] == COk(-4)
+    assert expr.deferred()("+".join(["1"] * 2000))[0] == COk(2000)
+
+
+def test_left_recursion_window():
+    d = RegExp(b"[0-9]").map(int)
+    e = Lazy(
+        lambda: e.skip(Bytes(b"-")).pair(d, lambda x, y: x - y).or_(d),
+        left_recursive=True,
+    )
+    record = length_prefixed(e, u8)
+    assert record(b"\x031-2-3")[0] == COk(-1)
+    ahead = Parser.seq(u8, e).lookahead()
+    assert Parser.seq(ahead, record)(b"\x031-2-3")[0] == COk([[3, -4], -1])
+
+
+def test_indirect_left_recursion():
+    a = Lazy(lambda: b.skip(String("a")).or_(String("x")), left_recursive=True)
+    b = Lazy(lambda: a.skip(String("b")).or_(String("y")), left_recursive=True)
+    with pytest.raises(GrammarError, match="Indirect left recursion"):
+        a("xbaba")
+    b = Lazy(lambda: a.skip(String("b")).or_(String("y")))
+    result, state = a("xbaba")
+    assert result == COk("x") and state.i == 5
+
+
+def test_grammar_nodes():
+    a = String("a")
+    b = RegExp("b+")
+    p = Parser.alt(a.then(b), b.map(len)).many()
+    assert isinstance(p, Many)
+    alt = p.p
+    assert isinstance(alt, Alt) and alt.children == (alt.parsers[0], alt.parsers[1])
+    then, mapped = alt.parsers
+    assert isinstance(then, Then) and then.children == (a, b)
+    assert isinstance(mapped, Map) and mapped.p is b and mapped.f is len
+    assert p("bbab")[0] == COk([2, "b"])
+
+
+def test_visitor():
+    class Literals(Visitor):
+        def __init__(self):
+            super().__init__()
+            self.literals = []
+
+        def visit_String(self, node):
+            self.literals.append(node.s)
+
+    expr = Lazy(lambda: String("(").then(expr).skip(String(")")).or_(String("x")))
+    visitor = Literals()
+    visitor.visit(expr.many())
+    assert visitor.literals == ["(", ")", "x"]
+
+
+def test_pformat():
+    expr = Lazy(lambda: String("(").then(expr).skip(String(")")).or_(String("x")))
+    assert pformat(expr.map(len)) == "\n".join(
+        [
+            "Map len",
+            "  Lazy #1",
+            "    Or",
+            "      Skip",
+            "        Then",
+            "          String('(')",
+            "          <#1>",
+            "        String(')')",
+            "      String('x')",
+        ]
+    )
+
+
+def test_generate():
+    number = RegExp(r"(?:0|[1-9]\d*)(?:\.\d{1,3})?")
+    word = take_while1("xyz").chain(lambda w: String("=" + w))
+    row = Parser.seq(number, one_of(";,"), word, none_of("\n"), String("\n"))
+    rows = row.many().skip(EOF())
+    for seed in range(20):
+        source = generate(rows, size=200, seed=seed)
+        assert rows.validate(source)
+    with pytest.raises(ValueError):
+        generate(Error())
+
+
+def test_generate_binary():
+    packet = Parser.seq(Bytes(b"P"), u16le, length_prefixed(take(2).many(), length=u8))
+    source = generate(packet.many(), size=100, seed=3)
+    assert isinstance(source, bytes) and len(source) >= 100
+    assert packet.many().validate(source)
+
+
+def test_tracer():
+    number = RegExp("[0-9]+").set_desc("number")
+    item = number.skip(String(",")).set_desc("item")
+    items = item.many().set_desc("items")
+    tracer = Tracer()
+    result, _ = items("1,22,x", tracer=tracer)
+    assert result == COk(["1", "22"])
+    phases = [(phase, name, offset) for phase, name, offset, _, _ in tracer.events]
+    assert phases == [
+        ("B", "items", 0),
+        ("B", "item", 0),
+        ("B", "number", 0),
+        ("E", "number", 1),
+        ("E", "item", 2),
+        ("B", "item", 2),
+        ("B", "number", 2),
+        ("E", "number", 4),
+        ("E", "item", 5),
+        ("B", "item", 5),
+        ("B", "number", 5),
+        ("E", "number", 5),
+        ("E", "item", 5),
+        ("E", "items", 5),
+    ]
+    trace = tracer.to_chrome_trace()
+    assert [e["ph"] for e in trace["traceEvents"]] == [p for p, _, _ in phases]
+    assert trace["traceEvents"][-1]["args"] == {"offset": 5, "result": "COk"}
+    json.dumps(trace)
+    stacks = [line.rsplit(" ", 1)[0] for line in tracer.to_collapsed().splitlines()]
+    assert stacks == ["items;item;number", "items;item", "items"]
+
+    tracer = Tracer(max_depth=1)
+    items("1,22,x", tracer=tracer)
+    assert {name for _, name, _, _, _ in tracer.events} == {"items"}
+
+    tracer = Tracer(sample=2)
+    item.many()("1,22,3,x", tracer=tracer)
+    assert [e[2] for e in tracer.events if e[0] == "B" and e[1] == "item"] == [0, 5]
+
+
+def test_analysis():
+    with pytest.raises(GrammarError):
+        RegExp("a*").many()
+    with pytest.raises(GrammarError):
+        String("a").or_(Return(None)).many()
+    assert String("a").many().consumes
+    assert not String("a").chain(lambda _: Return(1)).lookahead().many().consumes
+
+    lazy = Lazy(lambda: RegExp("a*"))
+    p = lazy.many()
+    with pytest.raises(GrammarError):
+        p.analyze()
+
+    item = Lazy(lambda: String("(").then(item.many()).skip(String(")")))
+    items = item.many()
+    assert not items.consumes
+    info = items.analyze()
+    assert items.consumes and items in info.nullable and item not in info.nullable
+    assert items("(()())()")[0] == COk([[[], []], []])
+
+    never = Parser.alt(Error(), String("a").then(Error()))
+    info = Parser.alt(String("b"), never).analyze()
+    assert never in info.never
+
+    deep = String("a")
+    for _ in range(2000):
+        deep = Parser.seq(deep, String("b")).many1()
+    assert deep.consumes
+
+
+def test_parse_partial():
+    calls = []
+    number = RegExp("[0-9]+").map(lambda x: calls.append(x) or int(x))
+    numbers = number.sep_by(String(",")).skip(String(";"))
+    out = numbers.parse_partial("12,3")
+    assert isinstance(out, NeedMore) and out.offset == 3 and calls == ["12"]
+    out = out.feed("4,")
+    assert isinstance(out, NeedMore) and out.offset == 6 and calls == ["12", "34"]
+    result, state = out.feed("5;rest")
+    assert result == COk([12, 34, 5]) and state.i == 8
+    assert calls == ["12", "34", "5"]
+
+    out = String("ab").then(EOF()).parse_partial("a")
+    out = out.feed("b")
+    assert isinstance(out, NeedMore)
+    assert out.finish()[0] == COk(None)
+    assert String("ab").parse_partial("ax")[0] == EErr()
+
+
+def test_parse_partial_long_tokens():
+    tokens = [('"[^"]*"', '"' + "ab" * 20000 + '"'), ("[a-z]+", "ab" * 20000)]
+    for pattern, source in tokens:
+        out = RegExp(pattern).skip(String(";")).parse_partial("")
+        for i in range(0, len(source), 10):
+            out = out.feed(source[i : i + 10])
+            assert isinstance(out, NeedMore) and out.offset == 0
+        assert out.feed(";")[0] == COk(source)
+    run = take_while("ab").skip(String(";"))
+    out = run.parse_partial("")
+    for _ in range(4000):
+        out = out.feed("ababababab")
+    assert out.feed(";x")[0] == COk("ab" * 20000)
+
+
+def test_parse_partial_abandoned():
+    threads = threading.active_count()
+    for _ in range(20):
+        String("abc").parse_partial("a")
+    out = String("abc").parse_partial("a").feed("b")
+    deadline = time.monotonic() + 5
+    while threading.active_count() > threads + 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert threading.active_count() == threads + 1
+    assert out.feed("c")[0] == COk("abc")
+
+
+def test_parse_partial_context():
+    var = contextvars.ContextVar("var", default=None)
+    var.set("caller")
+    p = String("a").map(lambda _: var.get()).many().skip(EOF())
+    out = p.parse_partial("aa").feed("a")
+    assert out.finish()[0] == COk(["caller"] * 3)
+
+
+def test_parse_partial_binary():
+    packet = Parser.seq(Bytes(b"P"), u16le, length_prefixed(take(1).many(), length=u8))
+    source = b"P\x01\x00\x03abcP\x02\x00\x00"
+    out = packet.many().skip(EOF()).parse_partial(b"")
+    for i in range(len(source)):
+        assert isinstance(out, NeedMore)
+        out = out.feed(source[i : i + 1])
+    result, state = out.finish()
+    assert [(m, n, [bytes(x) for x in xs]) for m, n, xs in result.value] == [
+        (b"P", 1, [b"a", b"b", b"c"]),
+        (b"P", 2, []),
+    ]
+
+
+def test_parse_batch():
+    number = RegExp("[0-9]+").map(int).map(lambda x: -x)
+    batch = number.parse_batch(["12", "x", "3a", ""])
+    assert batch == BatchResult([-12, None, -3, None], bytearray([0, 1, 0, 1]))
+    pair = number.skip(String(",")).pair(number)
+    batch = pair.parse_batch(["1,2", "1;2", "3,", "4,5"])
+    assert batch.values == [(-1, -2), None, None, (-4, -5)]
+    assert batch.failed == bytearray([0, 1, 1, 0])
+    assert RegExp("a*").parse_batch(["", "b"]).values == ["", ""]
+
+
+def brute_scan(parser, source):
+    matches = []
+    i = 0
+    while i < len(source):
+        result, state = parser(State(source, i))
+        if type(result) is COk:
+            matches.append(((i, state.i), result.value))
+            i = state.i
+        else:
+            i += 1
+    return matches
+
+
+nested = Lazy(lambda: String("(").then(nested).skip(String(")")).or_(String("x")))
+
+
+@pytest.mark.parametrize(
+    "parser",
+    [
+        RegExp("[a-z]+").skip(String("=")).pair(RegExp("[0-9]+").map(int)),
+        String("=").or_(one_of("ab").many1()),
+        RegExp("(?i)X|y*").skip(satisfy(str.isdigit)),
+        nested,
+        RegExp("[0-9]*"),
+    ],
+)
+def test_scan(parser):
+    source = "foo=12 (x) ab= bar=x, ((x)) Y7 x9 b=3 ((x) 0"
+    assert list(parser.scan(source)) == brute_scan(parser, source)
+    assert list(parser.finditer(source)) == brute_scan(parser, source)
+
+
+def test_scan_backtracking():
+    parser = Parser.seq(
+        RegExp("[a-z]+"), take_while("abc"), RegExp("[a-z0-9]*"), String(";")
+    )
+    source = "a" * 5000
+    start = time.perf_counter()
+    assert list(parser.scan(source)) == []
+    assert time.perf_counter() - start < 2
+    assert list(parser.scan("xx ab1;")) == [((3, 7), ["ab", "", "1", ";"])]
+
+    # Back-references can match any length, so nothing is chained after them.
+    parser = Parser.seq(RegExp(r"(a)\1"), String(";"))
+    start = time.perf_counter()
+    assert list(parser.scan("a" * 80000)) == []
+    assert time.perf_counter() - start < 2
+    assert list(parser.scan("a; aa;")) == [((3, 6), ["aa", ";"])]
+
+
+def test_scan_binary():
+    record = Bytes(b"\xff").then(u16be)
+    assert list(record.scan(b"\x00\xff\x01\x02\xff\xff\x00\x05\xff")) == [
+        ((1, 4), 0x0102),
+        ((4, 7), 0xFF00),
+    ]
+
+
+class Total:
+    def __init__(self):
+        self.total = 0
+
+    def append(self, x):
+        self.total += x
+
+    def finish(self):
+        return self.total
+
+
+def test_collect():
+    number = RegExp("[0-9]+").map(float)
+    doubles = number.sep_by(String(","), collect=array("d"))
+    result, state = doubles("1,2,3;")
+    assert result == COk(array("d", [1.0, 2.0, 3.0])) and state.i == 5
+    assert doubles("x")[0] == EOk(array("d"))
+    assert doubles.deferred()("4,5")[0] == COk(array("d", [4.0, 5.0]))
+    assert doubles.validate("4,5")
+    digits = one_of("0123456789").map(int).many1(collect=bytearray)
+    assert digits("123")[0] == COk(bytearray(b"\x01\x02\x03"))
+    assert digits("x")[0] == EErr()
+    assert number.skip(opt_whitespace).many(collect=Total)("1 2 3")[0] == COk(6.0)
+    assert number.many1()("1")[0] == COk([1.0])
+    with pytest.raises(TypeError):
+        number.many(collect=[])